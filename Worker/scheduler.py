@@ -0,0 +1,84 @@
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+# Number of recent queue waits per model kept for the percentile metrics
+WAIT_SAMPLE_SIZE = 1000
+
+
+class TokenBucket:
+    """Refills at `per_minute` units per minute, holding at most one minute's worth.
+
+    Callers reserve units up front and may drive the balance negative; the
+    returned delay is how long they must wait for the debt to be repaid, so
+    concurrent callers are admitted in the order they reserved.
+    """
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60
+        self.balance = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, amount):
+        """Take `amount` units and return the seconds to wait before using them."""
+        with self.lock:
+            now = time.monotonic()
+            self.balance = min(self.capacity, self.balance + (now - self.updated) * self.rate)
+            self.updated = now
+            # A request larger than the whole bucket would otherwise wait forever
+            self.balance -= min(amount, self.capacity)
+            return max(0.0, -self.balance / self.rate)
+
+
+class ModelScheduler:
+    """Admission control for one model: a concurrency cap plus request and token buckets.
+
+    `admit` blocks until the call may go out, so requests over budget are
+    delayed rather than failed, and records how long each one queued.
+    """
+
+    def __init__(self, max_concurrency, rpm=None, tpm=None):
+        self.slots = threading.BoundedSemaphore(max_concurrency)
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.lock = threading.Lock()
+        self.waits = deque(maxlen=WAIT_SAMPLE_SIZE)
+        self.counters = {"admitted": 0, "retries": 0, "wait_seconds_total": 0.0, "wait_seconds_max": 0.0}
+
+    @contextmanager
+    def admit(self, token_estimate):
+        started = time.monotonic()
+        with self.slots:
+            delay = 0.0
+            if self.requests:
+                delay = self.requests.reserve(1)
+            if self.tokens:
+                delay = max(delay, self.tokens.reserve(token_estimate))
+            if delay:
+                time.sleep(delay)
+            self._record_wait(time.monotonic() - started)
+            yield
+
+    def record_retry(self):
+        with self.lock:
+            self.counters["retries"] += 1
+
+    def _record_wait(self, wait):
+        with self.lock:
+            self.waits.append(wait)
+            self.counters["admitted"] += 1
+            self.counters["wait_seconds_total"] += wait
+            self.counters["wait_seconds_max"] = max(self.counters["wait_seconds_max"], wait)
+
+    def metrics(self):
+        """Counters plus p50/p95 queue wait over the last WAIT_SAMPLE_SIZE admissions."""
+        with self.lock:
+            waits = sorted(self.waits)
+            metrics = dict(self.counters)
+        if waits:
+            metrics["wait_seconds_p50"] = waits[len(waits) // 2]
+            metrics["wait_seconds_p95"] = waits[min(len(waits) - 1, int(len(waits) * 0.95))]
+        return {name: round(value, 4) if isinstance(value, float) else value for name, value in metrics.items()}
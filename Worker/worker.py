@@ -1,16 +1,26 @@
 import redis
 import json
+import hashlib
+import re
 import time
+import random
 import litellm
 import os
+import socket
 from dotenv import load_dotenv
 import tempfile
 import shutil
 import logging
 from fastapi import FastAPI
 import uvicorn
-from threading import Thread
+from threading import BoundedSemaphore, Event, Lock, Thread
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import lru_cache
 from google.cloud import storage
+from tokenization import chunk_markdown, count_tokens, pack_by_tokens
+from scheduler import ModelScheduler
 
 
 # Configure logging
@@ -19,9 +29,6 @@ logger = logging.getLogger(__name__)
 
 load_dotenv()
 
-# FastAPI application setup
-app = FastAPI()
-
 # Set up Redis client for communication
 REDIS_HOST = os.getenv("REDIS_HOST")
 REDIS_PORT = int(os.getenv("REDIS_PORT", 6379))
@@ -44,15 +51,111 @@ except redis.ConnectionError as e:
 
 STREAM_NAME = "llm_requests"
 
+# Consumer group shared by all worker replicas; each entry goes to exactly one consumer
+CONSUMER_GROUP = os.getenv("CONSUMER_GROUP", "llm_workers")
+CONSUMER_NAME = os.getenv("CONSUMER_NAME", f"{socket.gethostname()}-{os.getpid()}")
+# Pending entries idle this long are assumed abandoned by a crashed consumer. Entries
+# still being processed are re-claimed by their consumer every CLAIM_HEARTBEAT_INTERVAL
+# seconds, which resets their idle time, so long tasks are never taken over, including
+# ones held back by a model's scheduler (entries are only read once a task slot is free)
+CLAIM_IDLE_MS = int(os.getenv("CLAIM_IDLE_MS", 10 * 60 * 1000))
+CLAIM_INTERVAL = int(os.getenv("CLAIM_INTERVAL", 60))
+CLAIM_HEARTBEAT_INTERVAL = float(os.getenv("CLAIM_HEARTBEAT_INTERVAL", CLAIM_IDLE_MS / 1000 / 4))
+
+# Tasks kept in flight per worker process; LLM calls are network-bound, so threads suffice
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", 8))
+task_executor = ThreadPoolExecutor(max_workers=WORKER_CONCURRENCY, thread_name_prefix="llm-task")
+in_flight = BoundedSemaphore(WORKER_CONCURRENCY)
+# Entries being processed in this process, mapped to the consumer that read them
+in_flight_messages = {}
+in_flight_lock = Lock()
+# Set on shutdown; the consumer loop stops reading when it sees it
+shutting_down = Event()
+
+# Documents (by content hash) kept in memory, so repeated questions skip the Redis fetch
+DOCUMENT_CACHE_SIZE = int(os.getenv("DOCUMENT_CACHE_SIZE", 32))
+
+# Result cache shared with the API; entries expire after RESULT_CACHE_TTL and the
+# oldest are evicted once there are more than RESULT_CACHE_MAX_ENTRIES
+PROMPT_VERSION = os.getenv("PROMPT_VERSION", "v2")
+RESULT_CACHE_TTL = int(os.getenv("RESULT_CACHE_TTL", 24 * 3600))
+RESULT_CACHE_MAX_ENTRIES = int(os.getenv("RESULT_CACHE_MAX_ENTRIES", 5000))
+RESULT_CACHE_STATS = "result_cache:stats"
+RESULT_CACHE_INDEX = "result_cache:index"
+
+# Streamed deltas are kept this long after a task finishes, for late readers
+RESPONSE_STREAM_TTL = int(os.getenv("RESPONSE_STREAM_TTL", 3600))
+# Pub/sub channel announcing finished task ids to the API's long-poll waiters
+RESULT_CHANNEL = "task_results"
+
+# Map-reduce summarization: a prompt may use this share of the model's context window
+# (the rest is left for the reply), and no more than SUMMARY_MAX_CHUNK_TOKENS so long
+# documents are split into parts that can be summarized in parallel
+SUMMARY_CONTEXT_SHARE = float(os.getenv("SUMMARY_CONTEXT_SHARE", 0.5))
+SUMMARY_MAX_CHUNK_TOKENS = int(os.getenv("SUMMARY_MAX_CHUNK_TOKENS", 32000))
+summary_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("SUMMARY_CONCURRENCY", 8)), thread_name_prefix="llm-summary"
+)
+SUMMARY_MAP_PROMPT = "Summarize this part of a longer document. Keep the key facts, figures and names:\n\n"
+SUMMARY_REDUCE_PROMPT = (
+    "The following are summaries of consecutive parts of one document. "
+    "Combine them into a single summary of the whole document:\n\n"
+)
+
+# Markdown image links, including inline base64 data URIs from older documents
+IMAGE_LINK_PATTERN = re.compile(r"!\[[^\]]*\]\([^)]*\)\n?")
+
 # LLM model configurations with appropriate keys and provider info
 LLM_MODELS = {
-    "GPT-4o": {"model": "gpt-4o", "api_key": os.getenv("GPT4o_API_KEY")},  
-    "Gemini-Flash": {"model": "gemini/gemini-2.0-flash-exp", "api_key": os.getenv("GEMINI_API_KEY"), "provider": "google"},
-    "DeepSeek": {"model": "deepseek/deepseek-chat", "api_key": os.getenv("DEEPSEEK_API_KEY"), "provider": "deepseek"},
-    "Claude": {"model": "claude-3-5-sonnet-20240620", "api_key": os.getenv("CLAUDE_API_KEY")},  
-    "Grok": {"model": "xai/grok-2-1212", "api_key": os.getenv("GROK_API_KEY"), "provider": "grok"}
+    "GPT-4o": {
+        "model": "gpt-4o", "api_key": os.getenv("GPT4o_API_KEY"), "context_tokens": 128000,
+        "rpm": int(os.getenv("GPT4o_RPM", 500)), "tpm": int(os.getenv("GPT4o_TPM", 30000))
+    },
+    "Gemini-Flash": {
+        "model": "gemini/gemini-2.0-flash-exp", "api_key": os.getenv("GEMINI_API_KEY"), "provider": "google", "context_tokens": 1048576,
+        "rpm": int(os.getenv("GEMINI_RPM", 10)), "tpm": int(os.getenv("GEMINI_TPM", 4000000))
+    },
+    "DeepSeek": {
+        "model": "deepseek/deepseek-chat", "api_key": os.getenv("DEEPSEEK_API_KEY"), "provider": "deepseek", "context_tokens": 64000,
+        "rpm": int(os.getenv("DEEPSEEK_RPM", 60)), "tpm": int(os.getenv("DEEPSEEK_TPM", 1000000))
+    },
+    "Claude": {
+        "model": "claude-3-5-sonnet-20240620", "api_key": os.getenv("CLAUDE_API_KEY"), "context_tokens": 200000,
+        "rpm": int(os.getenv("CLAUDE_RPM", 50)), "tpm": int(os.getenv("CLAUDE_TPM", 40000))
+    },
+    "Grok": {
+        "model": "xai/grok-2-1212", "api_key": os.getenv("GROK_API_KEY"), "provider": "grok", "context_tokens": 131072,
+        "rpm": int(os.getenv("GROK_RPM", 60)), "tpm": int(os.getenv("GROK_TPM", 100000))
+    }
 }
 
+# Cap on concurrent calls per model, so one busy model cannot take every task slot
+MODEL_CONCURRENCY = int(os.getenv("MODEL_CONCURRENCY", 4))
+# Share of each provider's rpm/tpm limit this process may use; set to 1/replicas when scaling out
+RATE_LIMIT_SHARE = float(os.getenv("RATE_LIMIT_SHARE", 1.0))
+# Reply tokens assumed per call when charging the tokens-per-minute bucket
+RATE_LIMIT_OUTPUT_TOKENS = int(os.getenv("RATE_LIMIT_OUTPUT_TOKENS", 1000))
+model_schedulers = {
+    llm_name: ModelScheduler(
+        model_info.get("max_concurrency", MODEL_CONCURRENCY),
+        rpm=model_info.get("rpm", 0) * RATE_LIMIT_SHARE,
+        tpm=model_info.get("tpm", 0) * RATE_LIMIT_SHARE
+    )
+    for llm_name, model_info in LLM_MODELS.items()
+}
+
+# Retries of rate-limited and transient provider errors, with full-jitter exponential backoff
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", 4))
+LLM_BACKOFF_BASE = float(os.getenv("LLM_BACKOFF_BASE", 1.0))
+LLM_BACKOFF_MAX = float(os.getenv("LLM_BACKOFF_MAX", 30.0))
+RETRYABLE_ERRORS = (
+    litellm.RateLimitError,
+    litellm.Timeout,
+    litellm.APIConnectionError,
+    litellm.ServiceUnavailableError,
+    litellm.InternalServerError
+)
+
 '''
 
 def setup_google_credentials():
@@ -91,114 +194,484 @@ def setup_google_credentials():
         return None
 '''
 
-def call_llm(llm_name, prompt):
-    """Send a request to the selected LLM model using LiteLLM."""
+def get_cached_result(cache_key):
+    result = redis_client.get(cache_key)
+    redis_client.hincrby(RESULT_CACHE_STATS, "worker_hits" if result else "worker_misses", 1)
+    return result
+
+def store_cached_result(cache_key, result):
+    """Cache a result with a TTL and evict the oldest entries beyond RESULT_CACHE_MAX_ENTRIES."""
+    now = time.time()
+    pipe = redis_client.pipeline()
+    pipe.set(cache_key, result, ex=RESULT_CACHE_TTL)
+    pipe.zadd(RESULT_CACHE_INDEX, {cache_key: now})
+    # Entries past their TTL are already gone from Redis; drop them from the index too
+    pipe.zremrangebyscore(RESULT_CACHE_INDEX, 0, now - RESULT_CACHE_TTL)
+    pipe.zcard(RESULT_CACHE_INDEX)
+    size = pipe.execute()[-1]
+
+    if size > RESULT_CACHE_MAX_ENTRIES:
+        evicted = [key for key, _ in redis_client.zpopmin(RESULT_CACHE_INDEX, size - RESULT_CACHE_MAX_ENTRIES)]
+        if evicted:
+            redis_client.delete(*evicted)
+
+def call_llm(llm_name, prompt, cache_key=None, on_delta=None):
+    """Send a request to the selected LLM model using LiteLLM.
+
+    With a `cache_key`, a cached result is returned without calling the
+    model, and successful results are cached for later requests. `on_delta`
+    streams the completion (see `complete`).
+    """
     model_info = LLM_MODELS.get(llm_name)
 
     if not model_info or not model_info["api_key"]:
         return f"❌ Error: API key missing for {llm_name}"
 
-    try:
-        # Handle Gemini model specifically
-        if llm_name == "Gemini-Flash":
-            '''
-            # Make sure Google credentials are set up
-            credentials_path = setup_google_credentials()
-            if not credentials_path:
-                return f"❌ Error: Failed to set up Google credentials for {llm_name}"'
-            '''
-                
-            # Use the standard Google authentication method
-            response = litellm.completion(
-                model=model_info["model"],
-                messages=[{"role": "user", "content": prompt}],
-                api_key=model_info["api_key"],
-                provider=model_info["provider"]
-            )
-        # Handle other models
-        elif "provider" in model_info:
-            response = litellm.completion(
-                model=model_info["model"],
-                messages=[{"role": "user", "content": prompt}],
-                api_key=model_info["api_key"],
-                provider=model_info["provider"]
-            )
-        else:
-            response = litellm.completion(
-                model=model_info["model"],
-                messages=[{"role": "user", "content": prompt}],
-                api_key=model_info["api_key"]
-            )
-
-        return response['choices'][0]['message']['content']
+    if cache_key:
+        cached = get_cached_result(cache_key)
+        if cached:
+            logger.info(f"⚡ Result cache hit for {llm_name}")
+            return cached
 
-    except Exception as e:
-        error_msg = f"❌ Error calling {llm_name}: {str(e)}"
-        logger.error(error_msg)
-        return error_msg
+    response = complete(llm_name, model_info, prompt, on_delta)
 
-def process_redis_messages():
-    """Function to process Redis messages continuously in a background thread."""
-    logger.info("Worker started, waiting for messages...")
+    if cache_key and not response.startswith("❌"):
+        store_cached_result(cache_key, response)
+    return response
 
-    while True:
-        try:
-            # Read messages from the Redis stream
-            messages = redis_client.xread({STREAM_NAME: "0"}, count=1, block=1000)
+def backoff_delay(attempt):
+    """Full-jitter exponential backoff: uniform in [0, min(LLM_BACKOFF_MAX, base * 2^attempt)]."""
+    return random.uniform(0, min(LLM_BACKOFF_MAX, LLM_BACKOFF_BASE * 2 ** attempt))
 
-            for stream, message_list in messages:
-                for msg_id, msg_data in message_list:
-                    logger.info(f"🔍 Received raw message: {msg_data}")
+def complete(llm_name, model_info, prompt, on_delta=None):
+    """Make the LiteLLM completion call for a model; errors are returned as the result text.
 
-                    if "data" not in msg_data:
-                        logger.warning(f"⚠️ Skipping message {msg_id}, missing 'data' field.")
-                        continue
+    Each attempt waits for the model's scheduler, which holds calls back
+    while the model is at its concurrency, requests/min or tokens/min limit.
+    Rate limits and transient provider errors are retried with backoff, unless
+    part of a streamed reply has already been sent.
+    """
+    scheduler = model_schedulers[llm_name]
+    token_estimate = count_tokens(prompt, llm_name) + RATE_LIMIT_OUTPUT_TOKENS
+    streamed = []
 
-                    try:
-                        msg = json.loads(msg_data["data"])
-                    except json.JSONDecodeError:
-                        logger.warning(f"⚠️ Skipping malformed JSON: {msg_data}")
-                        continue
+    def forward(delta):
+        streamed.append(delta)
+        on_delta(delta)
 
-                    if "task_id" not in msg or "type" not in msg or "pdf_name" not in msg or "llm" not in msg or "content" not in msg:
-                        logger.warning(f"⚠️ Skipping invalid message: {msg}")
-                        continue
+    for attempt in range(LLM_MAX_RETRIES + 1):
+        try:
+            with scheduler.admit(token_estimate):
+                return request_completion(llm_name, model_info, prompt, forward if on_delta else None)
+        except RETRYABLE_ERRORS as e:
+            if attempt == LLM_MAX_RETRIES or streamed:
+                error_msg = f"❌ Error calling {llm_name}: {str(e)}"
+                logger.error(error_msg)
+                return error_msg
+            delay = backoff_delay(attempt)
+            scheduler.record_retry()
+            logger.warning(f"⚠️ {llm_name} call failed ({type(e).__name__}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+        except Exception as e:
+            error_msg = f"❌ Error calling {llm_name}: {str(e)}"
+            logger.error(error_msg)
+            return error_msg
+
+def request_completion(llm_name, model_info, prompt, on_delta=None):
+    """One LiteLLM completion call; provider errors are raised to `complete`.
+
+    With `on_delta`, the completion is streamed and each text delta is passed
+    to it as soon as it arrives.
+    """
+    # Handle Gemini model specifically
+    if llm_name == "Gemini-Flash":
+        '''
+        # Make sure Google credentials are set up
+        credentials_path = setup_google_credentials()
+        if not credentials_path:
+            return f"❌ Error: Failed to set up Google credentials for {llm_name}"'
+        '''
+            
+        # Use the standard Google authentication method
+        response = litellm.completion(
+            model=model_info["model"],
+            messages=[{"role": "user", "content": prompt}],
+            api_key=model_info["api_key"],
+            provider=model_info["provider"],
+            stream=on_delta is not None
+        )
+    # Handle other models
+    elif "provider" in model_info:
+        response = litellm.completion(
+            model=model_info["model"],
+            messages=[{"role": "user", "content": prompt}],
+            api_key=model_info["api_key"],
+            provider=model_info["provider"],
+            stream=on_delta is not None
+        )
+    else:
+        response = litellm.completion(
+            model=model_info["model"],
+            messages=[{"role": "user", "content": prompt}],
+            api_key=model_info["api_key"],
+            stream=on_delta is not None
+        )
+
+    if on_delta is None:
+        return response['choices'][0]['message']['content']
 
-                    task_id = msg["task_id"]
-                    content = msg["content"].strip()
+    # Streaming: forward each delta as it arrives and return the full text
+    parts = []
+    for chunk in response:
+        delta = chunk.choices[0].delta.content
+        if delta:
+            parts.append(delta)
+            on_delta(delta)
+    return "".join(parts)
+
+def strip_images(content):
+    """Remove image links from document markdown so prompts never carry image bytes."""
+    return IMAGE_LINK_PATTERN.sub("", content)
+
+@lru_cache(maxsize=DOCUMENT_CACHE_SIZE)
+def load_document(content_hash):
+    """Resolve a document by content hash, keeping recently used ones in a worker-local LRU."""
+    content = redis_client.get(f"document:{content_hash}")
+    if content is None:
+        raise KeyError(content_hash)
+    return strip_images(content).strip()
+
+def summary_chunk_budget(llm_name):
+    """Token budget for one summarization prompt with the given model.
+
+    With a tokens-per-minute limit, the prompt, its instructions and the reply
+    must also fit in one minute of this process's share, or the provider
+    rejects the call however long the scheduler holds it back.
+    """
+    model_info = LLM_MODELS.get(llm_name, {})
+    context_tokens = model_info.get("context_tokens", SUMMARY_MAX_CHUNK_TOKENS)
+    budget = min(int(context_tokens * SUMMARY_CONTEXT_SHARE), SUMMARY_MAX_CHUNK_TOKENS)
+    if model_info.get("tpm"):
+        instruction_tokens = max(count_tokens(prefix, llm_name) for prefix in (SUMMARY_MAP_PROMPT, SUMMARY_REDUCE_PROMPT))
+        tpm_budget = int(model_info["tpm"] * RATE_LIMIT_SHARE) - RATE_LIMIT_OUTPUT_TOKENS - instruction_tokens
+        # A tiny share still gets usable chunks; the scheduler paces them
+        budget = min(budget, max(tpm_budget, 1000))
+    return budget
+
+def prompt_cache_key(llm_name, prompt):
+    """Result cache key for an intermediate prompt, so unchanged chunks are not re-summarized."""
+    raw_key = "\x1f".join([PROMPT_VERSION, llm_name, prompt])
+    return f"result_cache:{hashlib.sha256(raw_key.encode('utf-8')).hexdigest()}"
+
+def call_llm_parallel(llm_name, prompts):
+    """Run several cached LLM calls concurrently; results come back in prompt order."""
+    return list(summary_executor.map(lambda prompt: call_llm(llm_name, prompt, prompt_cache_key(llm_name, prompt)), prompts))
+
+def reduce_summaries(llm_name, summaries, budget, on_delta=None):
+    """Merge partial summaries, recursing while they do not fit in one prompt; only the final merge is streamed."""
+    combined = "\n\n".join(summaries)
+    if len(summaries) == 1 or count_tokens(combined, llm_name) <= budget:
+        prompt = SUMMARY_REDUCE_PROMPT + combined
+        return call_llm(llm_name, prompt, prompt_cache_key(llm_name, prompt), on_delta)
+
+    # At least two summaries per group, so every level shrinks the list
+    groups = pack_by_tokens(summaries, llm_name, budget, min_per_group=2)
+    partials = call_llm_parallel(llm_name, [SUMMARY_REDUCE_PROMPT + "\n\n".join(group) for group in groups])
+    errors = [partial for partial in partials if partial.startswith("❌")]
+    if errors:
+        return errors[0]
+    return reduce_summaries(llm_name, partials, budget, on_delta)
+
+def summarize_document(llm_name, content, cache_key=None, on_delta=None):
+    """Summarize a document, using map-reduce when it does not fit in one prompt.
+
+    The document is split at page and paragraph boundaries into chunks that
+    fit the model's budget, the chunks are summarized in parallel, then the
+    partial summaries are reduced (recursively if needed). Every intermediate
+    call is cached by its prompt, so a re-run only redoes changed chunks.
+    """
+    budget = summary_chunk_budget(llm_name)
+    if count_tokens(content, llm_name) <= budget:
+        return call_llm(llm_name, f"Summarize this document:\n\n{content}", cache_key, on_delta)
+
+    if cache_key:
+        cached = get_cached_result(cache_key)
+        if cached:
+            return cached
+
+    chunks = chunk_markdown(content, llm_name, budget)
+    logger.info(f"🧩 Summarizing {len(chunks)} chunks with {llm_name} (budget {budget} tokens)")
+
+    partials = call_llm_parallel(llm_name, [SUMMARY_MAP_PROMPT + chunk for chunk in chunks])
+    errors = [partial for partial in partials if partial.startswith("❌")]
+    if errors:
+        return errors[0]
+
+    summary = reduce_summaries(llm_name, partials, budget, on_delta)
+    if cache_key and not summary.startswith("❌"):
+        store_cached_result(cache_key, summary)
+    return summary
+
+class ResponseStream:
+    """Appends a task's output to the Redis stream `response_stream:{task_id}` as it is generated.
+
+    Entries carry a `delta` field; a final entry with `done` marks the end.
+    Each attempt at a task begins with a `reset` entry, so readers drop what
+    an earlier attempt (e.g. on a crashed replica) had streamed.
+    """
+
+    def __init__(self, task_id):
+        self.key = f"response_stream:{task_id}"
+        self.started = False
+
+    def start(self):
+        # The TTL is set here too, so a stream abandoned by a crash still expires
+        pipe = redis_client.pipeline()
+        pipe.delete(self.key)
+        pipe.xadd(self.key, {"reset": "1"})
+        pipe.expire(self.key, RESPONSE_STREAM_TTL)
+        pipe.execute()
+
+    def write(self, delta):
+        redis_client.xadd(self.key, {"delta": delta})
+        self.started = True
+
+    def close(self, response):
+        # Cache hits produce no deltas and a failure can cut a stream short; send the result text then
+        if not self.started or response.startswith("❌"):
+            self.write(response)
+        redis_client.xadd(self.key, {"done": "1"})
+        redis_client.expire(self.key, RESPONSE_STREAM_TTL)
+
+def store_response(task_id, response):
+    """Store a task's result and announce it on RESULT_CHANNEL so waiting clients return at once."""
+    redis_client.set(f"response:{task_id}", response)
+    redis_client.publish(RESULT_CHANNEL, task_id)
+
+def format_excerpts(context):
+    """Render retrieved `{"page", "text"}` chunks as a page-labelled prompt section."""
+    return "\n\n".join(f"[Page {chunk['page']}]\n{chunk['text']}" for chunk in context)
+
+def ensure_consumer_group():
+    """Create the consumer group (and the stream) if they do not exist yet."""
+    try:
+        redis_client.xgroup_create(STREAM_NAME, CONSUMER_GROUP, id="0", mkstream=True)
+        logger.info(f"✅ Created consumer group {CONSUMER_GROUP} on {STREAM_NAME}")
+    except redis.ResponseError as e:
+        if "BUSYGROUP" not in str(e):
+            raise
+
+def ack_message(msg_id):
+    """Acknowledge a finished entry and drop it from the stream."""
+    redis_client.xack(STREAM_NAME, CONSUMER_GROUP, msg_id)
+    redis_client.xdel(STREAM_NAME, msg_id)
+
+def reclaim_stale_messages(count, consumer_name=CONSUMER_NAME):
+    """Take over up to `count` entries left pending by consumers that died mid-task.
+
+    Entries this process is still working on are never returned, even if
+    their heartbeat was late.
+    """
+    reply = redis_client.xautoclaim(
+        STREAM_NAME, CONSUMER_GROUP, consumer_name,
+        min_idle_time=CLAIM_IDLE_MS, start_id="0-0", count=count
+    )
+    with in_flight_lock:
+        claimed = [(msg_id, msg_data) for msg_id, msg_data in reply[1] if msg_id not in in_flight_messages]
+    if claimed:
+        logger.info(f"♻️ Reclaimed {len(claimed)} stale message(s) from {STREAM_NAME}")
+    return claimed
+
+def refresh_in_flight():
+    """Reset the idle time of the entries this process is working on, keeping their owners."""
+    owners = defaultdict(list)
+    with in_flight_lock:
+        for msg_id, consumer_name in in_flight_messages.items():
+            owners[consumer_name].append(msg_id)
+    for consumer_name, msg_ids in owners.items():
+        redis_client.xclaim(STREAM_NAME, CONSUMER_GROUP, consumer_name, 0, msg_ids, justid=True)
+
+def handle_message(msg_id, msg_data):
+    """Process a single stream entry and acknowledge it.
+
+    Malformed entries are acknowledged and dropped. If processing raises, the
+    entry stays pending so another consumer can reclaim it.
+    """
+    logger.info(f"🔍 Received message {msg_id}")
+
+    if not msg_data or "data" not in msg_data:
+        logger.warning(f"⚠️ Skipping message {msg_id}, missing 'data' field.")
+        ack_message(msg_id)
+        return
 
-                    if not content:
-                        logger.warning(f"⚠️ Skipping {task_id}: No content provided.")
-                        redis_client.set(f"response:{task_id}", "❌ Error: Document is empty, cannot summarize.")
-                        continue
+    try:
+        msg = json.loads(msg_data["data"])
+    except json.JSONDecodeError:
+        logger.warning(f"⚠️ Skipping malformed JSON: {msg_data}")
+        ack_message(msg_id)
+        return
+
+    if "task_id" not in msg or "type" not in msg or "pdf_name" not in msg or "llm" not in msg \
+            or ("content_hash" not in msg and "content" not in msg):
+        logger.warning(f"⚠️ Skipping invalid message: {msg}")
+        ack_message(msg_id)
+        return
+
+    task_id = msg["task_id"]
+    excerpts = msg["type"] == "qa" and bool(msg.get("context"))
+    if excerpts:
+        # The API retrieved the relevant chunks; the full document is not needed
+        content = format_excerpts(msg["context"])
+    elif "content_hash" in msg:
+        try:
+            content = load_document(msg["content_hash"])
+        except KeyError:
+            logger.warning(f"⚠️ Skipping {task_id}: document {msg['content_hash']} not found in Redis.")
+            store_response(task_id, "❌ Error: Document is no longer available, please try again.")
+            ack_message(msg_id)
+            return
+    else:
+        content = strip_images(msg["content"]).strip()
+
+    if not content:
+        logger.warning(f"⚠️ Skipping {task_id}: No content provided.")
+        store_response(task_id, "❌ Error: Document is empty, cannot summarize.")
+        ack_message(msg_id)
+        return
+
+    logger.info(f"🚀 Processing Task: {task_id} - Type: {msg['type']} - Model: {msg['llm']}")
+
+    # Only trust the API's cache key if it was built for the prompts this worker sends
+    cache_key = msg.get("cache_key") if msg.get("prompt_version") == PROMPT_VERSION else None
+
+    # Summarize (map-reduce for long documents) or answer the question, streaming tokens as they arrive
+    stream = ResponseStream(task_id)
+    stream.start()
+    if msg["type"] == "summarize":
+        response = summarize_document(msg["llm"], content, cache_key, stream.write)
+    elif msg["type"] == "qa":
+        if excerpts:
+            prompt = (
+                f"Answer this question: {msg['question']} based on the following excerpts from the document. "
+                f"Cite the page numbers you used, e.g. (p. 3).\n\n{content}"
+            )
+        else:
+            prompt = f"Answer this question: {msg['question']} based on the following document:\n\n{content}"
+        response = call_llm(msg["llm"], prompt, cache_key, stream.write)
+    else:
+        logger.warning(f"⚠️ Unknown task type: {msg['type']}")
+        ack_message(msg_id)
+        return
 
-                    logger.info(f"🚀 Processing Task: {task_id} - Type: {msg['type']} - Model: {msg['llm']}")
+    # Store the response in Redis
+    store_response(task_id, response)  # ✅ Store result
+    stream.close(response)
+    logger.info(f"✅ Task {task_id} completed and stored in Redis")
 
-                    # Prepare prompt based on task type (summarize or QA)
-                    if msg["type"] == "summarize":
-                        prompt = f"Summarize this document:\n\n{content}"
-                    elif msg["type"] == "qa":
-                        prompt = f"Answer this question: {msg['question']} based on the following document:\n\n{content}"
-                    else:
-                        logger.warning(f"⚠️ Unknown task type: {msg['type']}")
-                        continue
+    # Acknowledge only once the result is stored, so a crash before this point gets retried
+    ack_message(msg_id)
 
-                    # Call the LLM with the appropriate model and prompt
-                    response = call_llm(msg["llm"], prompt)
+def dispatch_message(msg_id, msg_data, consumer_name=CONSUMER_NAME):
+    """Run a message on the task pool; its in-flight slot is released when it finishes."""
+    def run():
+        try:
+            handle_message(msg_id, msg_data)
+        except Exception as e:
+            logger.error(f"❌ Task for message {msg_id} failed, leaving it pending: {str(e)}")
+        finally:
+            with in_flight_lock:
+                in_flight_messages.pop(msg_id, None)
+            in_flight.release()
+
+    with in_flight_lock:
+        in_flight_messages[msg_id] = consumer_name
+    task_executor.submit(run)
+
+def acquire_free_slots():
+    """Wait up to a second for a free in-flight slot, then grab any others that are free."""
+    if not in_flight.acquire(timeout=1):
+        return 0
+    free = 1
+    while free < WORKER_CONCURRENCY and in_flight.acquire(blocking=False):
+        free += 1
+    return free
+
+def process_redis_messages(consumer_name=CONSUMER_NAME):
+    """Function to process Redis messages continuously in a background thread.
+
+    Workers share the CONSUMER_GROUP, so each entry is delivered to exactly
+    one replica; entries a crashed replica left pending are reclaimed after
+    CLAIM_IDLE_MS, while the entries being processed are kept fresh by the
+    heartbeat. Up to WORKER_CONCURRENCY tasks run at once on the task pool,
+    and the loop only reads as many entries as there are free slots.
+    """
+    logger.info(f"Worker {consumer_name} started, waiting for messages...")
+    group_ready = False
+    last_claim = 0.0
+    last_heartbeat = time.monotonic()
+
+    while not shutting_down.is_set():
+        free = 0
+        try:
+            if not group_ready:
+                ensure_consumer_group()
+                group_ready = True
+
+            if time.monotonic() - last_heartbeat >= CLAIM_HEARTBEAT_INTERVAL:
+                last_heartbeat = time.monotonic()
+                refresh_in_flight()
+
+            free = acquire_free_slots()
+            if not free:
+                continue
+
+            if time.monotonic() - last_claim >= CLAIM_INTERVAL:
+                last_claim = time.monotonic()
+                for msg_id, msg_data in reclaim_stale_messages(free, consumer_name):
+                    free -= 1
+                    dispatch_message(msg_id, msg_data, consumer_name)
+
+            if free:
+                # Read as many new messages as there are free slots
+                messages = redis_client.xreadgroup(
+                    CONSUMER_GROUP, consumer_name, {STREAM_NAME: ">"}, count=free, block=1000
+                )
+
+                for stream, message_list in messages:
+                    for msg_id, msg_data in message_list:
+                        free -= 1
+                        dispatch_message(msg_id, msg_data, consumer_name)
+
+        except redis.ResponseError as e:
+            # The group disappears if the stream is deleted; recreate it on the next pass
+            logger.error(f"❌ Worker Error: {str(e)}")
+            if "NOGROUP" in str(e):
+                group_ready = False
+            time.sleep(2)
+        except Exception as e:
+            logger.error(f"❌ Worker Error: {str(e)}")
+            time.sleep(2)
+        finally:
+            # Hand back the slots no message was dispatched to
+            for _ in range(free):
+                in_flight.release()
 
-                    # Store the response in Redis
-                    redis_client.set(f"response:{task_id}", response)  # ✅ Store result
-                    logger.info(f"✅ Task {task_id} completed and stored in Redis")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Run the Redis consumer loop in a background thread while the app is up."""
+    shutting_down.clear()
+    Thread(target=process_redis_messages, name="redis-consumer", daemon=True).start()
+    yield
+    shutting_down.set()
 
-                    # Mark the task as processed by deleting it from the Redis stream
-                    redis_client.xdel(STREAM_NAME, msg_id)  # ✅ Delete processed task
 
-            # Sleep briefly before checking for new messages
-            time.sleep(1)
+# FastAPI application setup
+app = FastAPI(lifespan=lifespan)
 
-        except Exception as e:
-            logger.error(f"❌ Worker Error: {str(e)}")
-            time.sleep(2)
+@app.get("/metrics")
+def metrics():
+    """Per-model scheduler counters: admissions, retries and queue wait times in seconds."""
+    return {llm_name: scheduler.metrics() for llm_name, scheduler in model_schedulers.items()}
 
 # Setup Google credentials at startup
 '''
@@ -206,11 +679,6 @@ if "Gemini-Flash" in LLM_MODELS:
     setup_google_credentials()'
 '''
 
-# Run the Redis worker in a background thread
-thread = Thread(target=process_redis_messages)
-thread.daemon = True
-thread.start()
-
 # Make sure you bind to 0.0.0.0 and port 8080
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=int(os.getenv("PORT", 8080)))
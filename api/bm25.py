@@ -0,0 +1,121 @@
+import re
+import sys
+import json
+import math
+import heapq
+import struct
+from array import array
+from collections import Counter, defaultdict
+
+TOKEN_PATTERN = re.compile(r"\w+")
+MAGIC = b"BM25\x01"
+
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+class BM25Index:
+    """Inverted index over document pages, scored with Okapi BM25.
+
+    Pages are added one at a time, so the index can be built inside the
+    extraction loop. Postings are kept as parallel `array("I")` columns of
+    page slots and term frequencies, which is also how they are persisted.
+    """
+
+    def __init__(self, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.page_numbers = array("I")
+        self.page_lengths = array("I")
+        self.postings = {}
+
+    def add_page(self, page_num, text):
+        terms = tokenize(text)
+        slot = len(self.page_numbers)
+        self.page_numbers.append(page_num)
+        self.page_lengths.append(len(terms))
+        for term, tf in Counter(terms).items():
+            slots, tfs = self.postings.setdefault(term, (array("I"), array("I")))
+            slots.append(slot)
+            tfs.append(tf)
+
+    def search(self, query, k=3):
+        """Return up to `k` `(page_num, score)` pairs, best first."""
+        page_count = len(self.page_numbers)
+        if not page_count:
+            return []
+        avg_length = (sum(self.page_lengths) / page_count) or 1.0
+
+        scores = defaultdict(float)
+        for term in set(tokenize(query)):
+            if term not in self.postings:
+                continue
+            slots, tfs = self.postings[term]
+            idf = math.log(1 + (page_count - len(slots) + 0.5) / (len(slots) + 0.5))
+            for slot, tf in zip(slots, tfs):
+                length_norm = 1 - self.b + self.b * self.page_lengths[slot] / avg_length
+                scores[slot] += idf * tf * (self.k1 + 1) / (tf + self.k1 * length_norm)
+
+        best = heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+        return [(self.page_numbers[slot], score) for slot, score in best]
+
+    def to_bytes(self):
+        """Serialize as magic, a JSON header (terms and document frequencies), then the raw arrays."""
+        terms = sorted(self.postings)
+        header = json.dumps({
+            "k1": self.k1,
+            "b": self.b,
+            "pages": len(self.page_numbers),
+            "terms": terms,
+            "df": [len(self.postings[term][0]) for term in terms]
+        }).encode("utf-8")
+
+        slots = array("I")
+        tfs = array("I")
+        for term in terms:
+            slots.extend(self.postings[term][0])
+            tfs.extend(self.postings[term][1])
+
+        parts = [MAGIC, struct.pack("<I", len(header)), header]
+        for column in (self.page_numbers, self.page_lengths, slots, tfs):
+            parts.append(_little_endian(column).tobytes())
+        return b"".join(parts)
+
+    @classmethod
+    def from_bytes(cls, data):
+        if not data.startswith(MAGIC):
+            raise ValueError("Not a BM25 index file")
+        offset = len(MAGIC)
+        (header_length,) = struct.unpack_from("<I", data, offset)
+        offset += 4
+        header = json.loads(data[offset:offset + header_length])
+        offset += header_length
+
+        def read_column(count):
+            nonlocal offset
+            column = array("I")
+            column.frombytes(data[offset:offset + count * column.itemsize])
+            offset += count * column.itemsize
+            return _little_endian(column)
+
+        index = cls(header["k1"], header["b"])
+        index.page_numbers = read_column(header["pages"])
+        index.page_lengths = read_column(header["pages"])
+        posting_count = sum(header["df"])
+        slots = read_column(posting_count)
+        tfs = read_column(posting_count)
+
+        start = 0
+        for term, df in zip(header["terms"], header["df"]):
+            index.postings[term] = (slots[start:start + df], tfs[start:start + df])
+            start += df
+        return index
+
+
+def _little_endian(column):
+    """Return `column` in little-endian byte order (the on-disk order), swapping a copy if needed."""
+    if sys.byteorder == "big":
+        column = array(column.typecode, column)
+        column.byteswap()
+    return column
@@ -0,0 +1,244 @@
+import os
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger(__name__)
+
+
+class DocumentCache:
+    """Read-through cache of S3 objects on local disk, with an in-memory tier for hot ones.
+
+    A local copy is revalidated against the object's ETag at most every
+    `validate_interval` seconds. Downloads are checked against the SHA-256 in
+    the object's `sha256` metadata, or else against a single-part ETag's MD5.
+    Concurrent reads of one key share a single download. Files are
+    evicted least-recently-used once they exceed `disk_bytes`, except while
+    a reader holds them through `acquire`; objects read `hot_min_hits` times
+    or more are also kept in memory within `hot_bytes`.
+    """
+
+    def __init__(self, s3_client, bucket, disk_bytes, hot_bytes, validate_interval=60, hot_min_hits=2):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.disk_bytes = disk_bytes
+        self.hot_bytes = hot_bytes
+        self.validate_interval = validate_interval
+        self.hot_min_hits = hot_min_hits
+
+        # key -> {"path", "size", "etag", "validated_at", "hits"}, least recently used first
+        self.entries = OrderedDict()
+        # key -> (etag, data), least recently used first
+        self.hot = OrderedDict()
+        self.disk_size = 0
+        self.hot_size = 0
+        self.lock = threading.Lock()
+        self.key_locks = {}
+        # key -> number of readers holding its file open; these are never evicted
+        self.pins = {}
+        self.counters = {"hot_hits": 0, "disk_hits": 0, "validations": 0, "downloads": 0, "evictions": 0}
+
+    def adopt_directory(self, local_dir, prefix):
+        """Account for files already in `local_dir`, stored in S3 under `prefix/`, oldest first.
+
+        Their ETags are unknown, so each is revalidated on first use.
+        """
+        paths = [
+            os.path.join(local_dir, name) for name in os.listdir(local_dir)
+            if not name.endswith(".part") and os.path.isfile(os.path.join(local_dir, name))
+        ]
+        for path in sorted(paths, key=os.path.getmtime):
+            self._record(f"{prefix}/{os.path.basename(path)}", path, None, validated=False)
+
+    def put(self, key, local_path, etag=None):
+        """Register a file just written locally and uploaded to S3 as `key`."""
+        with self._key_lock(key):
+            self._record(key, local_path, etag)
+
+    def path(self, key, local_path):
+        """Return `local_path` holding a current copy of `key`, downloading it if needed.
+
+        Raises FileNotFoundError when the object is neither in S3 nor on disk.
+        """
+        with self._key_lock(key):
+            with self.lock:
+                entry = self.entries.get(key)
+                if entry and entry["path"] == local_path and self._is_fresh(entry) and os.path.exists(local_path):
+                    self.entries.move_to_end(key)
+                    self.counters["disk_hits"] += 1
+                    return local_path
+
+            remote = self._remote_head(key)
+            if os.path.exists(local_path) and (remote is None or self._matches(local_path, entry, remote)):
+                # The local copy matches S3, or S3 cannot say otherwise
+                self._record(key, local_path, remote["etag"] if remote else (entry or {}).get("etag"))
+                return local_path
+            if remote is None:
+                raise FileNotFoundError(key)
+
+            self._download(key, local_path, remote)
+            return local_path
+
+    def acquire(self, key, local_path):
+        """Like `path`, but the file is kept on disk until `release(key)` is called."""
+        with self.lock:
+            self.pins[key] = self.pins.get(key, 0) + 1
+        try:
+            return self.path(key, local_path)
+        except BaseException:
+            self.release(key)
+            raise
+
+    def release(self, key):
+        """Let a file returned by `acquire` be evicted again."""
+        with self.lock:
+            self.pins[key] -= 1
+            if not self.pins[key]:
+                del self.pins[key]
+                self._evict(keep=key)
+
+    def read_bytes(self, key, local_path):
+        """Contents of `key`, served from memory when it is hot and still current."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if key in self.hot and entry and self._is_fresh(entry) and self.hot[key][0] == entry["etag"]:
+                self.hot.move_to_end(key)
+                self.entries.move_to_end(key)
+                self.counters["hot_hits"] += 1
+                return self.hot[key][1]
+
+        self.acquire(key, local_path)
+        try:
+            with self.lock:
+                entry = self.entries[key]
+                hot = self.hot.get(key)
+                if hot and hot[0] == entry["etag"]:
+                    self.hot.move_to_end(key)
+                    return hot[1]
+
+            with open(local_path, "rb") as cached_file:
+                data = cached_file.read()
+        finally:
+            self.release(key)
+
+        with self.lock:
+            entry["hits"] += 1
+            if entry["hits"] >= self.hot_min_hits and len(data) <= self.hot_bytes:
+                self._drop_hot(key)
+                self.hot[key] = (entry["etag"], data)
+                self.hot_size += len(data)
+                while self.hot_size > self.hot_bytes:
+                    self._drop_hot(next(iter(self.hot)))
+        return data
+
+    def stats(self):
+        with self.lock:
+            return {
+                **self.counters,
+                "disk_entries": len(self.entries),
+                "disk_bytes": self.disk_size,
+                "hot_entries": len(self.hot),
+                "hot_bytes": self.hot_size
+            }
+
+    def _key_lock(self, key):
+        with self.lock:
+            return self.key_locks.setdefault(key, threading.Lock())
+
+    def _is_fresh(self, entry):
+        return time.monotonic() - entry["validated_at"] < self.validate_interval
+
+    def _remote_head(self, key):
+        """The object's current `{"etag", "sha256"}`; None if it does not exist or S3 cannot be reached."""
+        with self.lock:
+            self.counters["validations"] += 1
+        try:
+            head = self.s3_client.head_object(Bucket=self.bucket, Key=key)
+            return {"etag": head["ETag"].strip('"'), "sha256": head.get("Metadata", {}).get("sha256")}
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") not in ("404", "NoSuchKey", "NotFound"):
+                logger.warning(f"⚠️ Could not validate {key} against S3: {e}")
+            return None
+        except Exception as e:
+            logger.warning(f"⚠️ Could not validate {key} against S3: {e}")
+            return None
+
+    def _matches(self, local_path, entry, remote):
+        if entry and entry["etag"]:
+            return entry["etag"] == remote["etag"]
+        return _content_matches(local_path, remote) is True
+
+    def _download(self, key, local_path, remote):
+        partial_path = f"{local_path}.part"
+        self.s3_client.download_file(self.bucket, key, partial_path)
+        if _content_matches(partial_path, remote) is False:
+            os.remove(partial_path)
+            raise IOError(f"Downloaded {key} does not match its checksum")
+        os.replace(partial_path, local_path)
+        with self.lock:
+            self.counters["downloads"] += 1
+            self._drop_hot(key)
+        self._record(key, local_path, remote["etag"])
+
+    def _record(self, key, local_path, etag, validated=True):
+        size = os.path.getsize(local_path)
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous:
+                self.disk_size -= previous["size"]
+                if previous["etag"] != etag:
+                    self._drop_hot(key)
+            self.entries[key] = {
+                "path": local_path,
+                "size": size,
+                "etag": etag,
+                "validated_at": time.monotonic() if validated else float("-inf"),
+                "hits": previous["hits"] if previous else 0
+            }
+            self.disk_size += size
+            # Never evict the entry just recorded, even if it alone exceeds the budget
+            self._evict(keep=key)
+
+    def _evict(self, keep=None):
+        """Remove least recently used files until the disk budget is met; call with `self.lock` held."""
+        for key in list(self.entries):
+            if self.disk_size <= self.disk_bytes:
+                return
+            if key == keep or key in self.pins:
+                continue
+            evicted = self.entries.pop(key)
+            self.disk_size -= evicted["size"]
+            self._drop_hot(key)
+            self.counters["evictions"] += 1
+            try:
+                os.remove(evicted["path"])
+            except FileNotFoundError:
+                pass
+
+    def _drop_hot(self, key):
+        hot = self.hot.pop(key, None)
+        if hot:
+            self.hot_size -= len(hot[1])
+
+
+def _content_matches(path, remote):
+    """Whether a file holds the object's content; None if the object carries no usable checksum.
+
+    Single-part uploads have the MD5 of the content as ETag; multipart ones
+    can only be checked through their `sha256` metadata.
+    """
+    if remote["sha256"]:
+        return _digest(path, hashlib.sha256()) == remote["sha256"]
+    if "-" not in remote["etag"]:
+        return _digest(path, hashlib.md5()) == remote["etag"]
+    return None
+
+
+def _digest(path, digest):
+    with open(path, "rb") as cached_file:
+        for block in iter(lambda: cached_file.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
@@ -1,16 +1,35 @@
 import os
+import re
 import json
+import hashlib
 import boto3
 import base64
-import io
+import time
+import shutil
+import asyncio
+import threading
 import uvicorn
 import redis
+import redis.asyncio as aioredis
 import fitz  # PyMuPDF for PDF parsing
 from fastapi import FastAPI, UploadFile, File, Form, HTTPException
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi.responses import JSONResponse, FileResponse, StreamingResponse
 from dotenv import load_dotenv
 import logging
-from openSourcePdf import extract_data, save_to_md
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import lru_cache, partial
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from collections import defaultdict, deque
+from typing import List
+from bm25 import BM25Index
+from document_cache import DocumentCache
+from retrieval import EMBEDDING_MODEL, HashingEmbedder, VectorIndex, chunk_page
+from tokenization import TokenCounter, count_tokens
+from openSourcePdf import (
+    count_pages, iter_pages, new_image_stats, save_to_md, shutdown_extraction_pool, split_page_sections
+)
 
 # Load environment variables
 load_dotenv()
@@ -24,6 +43,19 @@ AWS_ACCESS_KEY = os.getenv("AWS_ACCESS_KEY_ID")
 AWS_SECRET_KEY = os.getenv("AWS_SECRET_ACCESS_KEY")
 S3_BUCKET_NAME = os.getenv("S3_BUCKET_NAME")
 S3_REGION = os.getenv("S3_REGION")
+# boto3 clients are thread-safe; size the HTTP pool to the threads that share it
+S3_MAX_POOL_CONNECTIONS = int(os.getenv("S3_MAX_POOL_CONNECTIONS", 32))
+# Large objects go up as multipart uploads of this part size (S3's minimum is 5 MiB),
+# raw PDFs with S3_UPLOAD_CONCURRENCY parts in flight
+S3_MULTIPART_CHUNK_SIZE = max(int(os.getenv("S3_MULTIPART_CHUNK_SIZE", 8 * 1024 * 1024)), 5 * 1024 * 1024)
+S3_UPLOAD_CONCURRENCY = int(os.getenv("S3_UPLOAD_CONCURRENCY", 4))
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=S3_MULTIPART_CHUNK_SIZE,
+    multipart_chunksize=S3_MULTIPART_CHUNK_SIZE,
+    max_concurrency=S3_UPLOAD_CONCURRENCY
+)
+# Request bodies are copied to disk in blocks of this size
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", 1024 * 1024))
 
 
 s3_client = boto3.client(
@@ -31,34 +63,199 @@ s3_client = boto3.client(
     aws_access_key_id=AWS_ACCESS_KEY,
     aws_secret_access_key=AWS_SECRET_KEY,
     region_name=S3_REGION,
+    config=Config(max_pool_connections=S3_MAX_POOL_CONNECTIONS)
 )
+# Async handlers hand S3 and other blocking work to this pool instead of stalling the event loop
+io_executor = ThreadPoolExecutor(max_workers=S3_MAX_POOL_CONNECTIONS, thread_name_prefix="io")
+
+
+async def run_blocking(func, *args, **kwargs):
+    """Run blocking S3, disk or CPU work on the I/O pool and await its result."""
+    return await asyncio.get_running_loop().run_in_executor(io_executor, partial(func, *args, **kwargs))
 
-def upload_to_s3(file_content: bytes, folder: str, filename: str, content_type: str) -> None:
+def upload_to_s3(file_content, folder: str, filename: str, content_type: str) -> str:
+    """Store an object in S3 and return its ETag."""
     s3_path = f"{folder}/{filename}"
     try:
-        s3_client.put_object(
+        response = s3_client.put_object(
             Bucket=S3_BUCKET_NAME,
             Key=s3_path,
             Body=file_content,
             ContentType=content_type
         )
+        return response["ETag"].strip('"')
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"S3 Upload Failed: {str(e)}")
-    
+
+
+def upload_file_to_s3(file_path: str, folder: str, filename: str, content_type: str) -> None:
+    """Upload a local file to S3, as a parallel multipart upload once it exceeds one part."""
+    try:
+        s3_client.upload_file(
+            file_path,
+            S3_BUCKET_NAME,
+            f"{folder}/{filename}",
+            ExtraArgs={"ContentType": content_type},
+            Config=TRANSFER_CONFIG
+        )
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"S3 Upload Failed: {str(e)}")
+
+
+class S3MultipartWriter:
+    """Text sink that streams into an S3 object, as a multipart upload once it exceeds one part.
+
+    Written text is encoded and sent one S3_MULTIPART_CHUNK_SIZE part at a
+    time, so only the part being filled is held in memory; it is also copied
+    to `mirror` (e.g. the local file) when given. Used as a context manager,
+    the upload is completed on a clean exit and aborted on error, after
+    which `etag` holds the object's ETag. Content that fits in one part is
+    sent with a single put. The object carries the SHA-256 of its content
+    as `sha256` metadata, since a multipart ETag is not a content hash.
+    """
+
+    def __init__(self, folder: str, filename: str, content_type: str, mirror=None):
+        self.key = f"{folder}/{filename}"
+        self.content_type = content_type
+        self.mirror = mirror
+        self.upload_id = None
+        self.parts = []
+        self.buffer = bytearray()
+        self.sha256 = hashlib.sha256()
+        self.etag = None
+
+    def __enter__(self):
+        return self
+
+    def write(self, text: str) -> None:
+        if self.mirror is not None:
+            self.mirror.write(text)
+        data = text.encode("utf-8")
+        self.sha256.update(data)
+        self.buffer += data
+        if len(self.buffer) >= S3_MULTIPART_CHUNK_SIZE:
+            self._upload_part()
+
+    def _upload_part(self) -> None:
+        if self.upload_id is None:
+            self.upload_id = s3_client.create_multipart_upload(
+                Bucket=S3_BUCKET_NAME, Key=self.key, ContentType=self.content_type
+            )["UploadId"]
+        part_number = len(self.parts) + 1
+        response = s3_client.upload_part(
+            Bucket=S3_BUCKET_NAME, Key=self.key, UploadId=self.upload_id, PartNumber=part_number, Body=bytes(self.buffer)
+        )
+        self.parts.append({"ETag": response["ETag"], "PartNumber": part_number})
+        self.buffer.clear()
+
+    def _complete(self) -> str:
+        metadata = {"sha256": self.sha256.hexdigest()}
+        if self.upload_id is None:
+            return s3_client.put_object(
+                Bucket=S3_BUCKET_NAME, Key=self.key, Body=bytes(self.buffer),
+                ContentType=self.content_type, Metadata=metadata
+            )["ETag"]
+
+        # The last part may be smaller than the part size
+        if self.buffer:
+            self._upload_part()
+        s3_client.complete_multipart_upload(
+            Bucket=S3_BUCKET_NAME, Key=self.key, UploadId=self.upload_id, MultipartUpload={"Parts": self.parts}
+        )
+        # The hash is only known now; a server-side copy onto itself attaches it
+        return s3_client.copy_object(
+            Bucket=S3_BUCKET_NAME, Key=self.key, CopySource={"Bucket": S3_BUCKET_NAME, "Key": self.key},
+            ContentType=self.content_type, Metadata=metadata, MetadataDirective="REPLACE"
+        )["CopyObjectResult"]["ETag"]
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            try:
+                self.etag = self._complete().strip('"')
+                return False
+            except Exception as e:
+                self._abort()
+                raise HTTPException(status_code=500, detail=f"S3 Upload Failed: {str(e)}")
+
+        self._abort()
+        return False
+
+    def _abort(self) -> None:
+        if self.upload_id is not None:
+            s3_client.abort_multipart_upload(Bucket=S3_BUCKET_NAME, Key=self.key, UploadId=self.upload_id)
+
+
+# "inline" embeds extracted images as base64; "s3" stores them as separate content-addressed
+# objects linked by their public bucket URL, so it needs new_upload/images/ to be publicly readable
+IMAGE_STORAGE = os.getenv("IMAGE_STORAGE", "inline")
+IMAGE_FOLDER = "new_upload/images"
+
+
+def s3_image_store():
+    """Return an image store for save_to_md that uploads each distinct image once.
+
+    Objects are keyed by the SHA-256 of their bytes, so an image shared by
+    many documents is stored a single time and the markdown only holds its URL.
+    """
+    uploaded = set()
+
+    def store(image):
+        image_name = f"{image['sha256']}.{image['ext']}"
+        if image_name not in uploaded:
+            upload_to_s3(image["data"], IMAGE_FOLDER, image_name, f"image/{image['ext']}")
+            uploaded.add(image_name)
+        return f"https://{S3_BUCKET_NAME}.s3.{S3_REGION}.amazonaws.com/{IMAGE_FOLDER}/{image_name}"
+
+    return store
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Start the background listeners, and release the pools and clients on shutdown."""
+    result_notifier.start()
+    threading.Thread(target=catalog_reconciler, name="catalog-reconciler", daemon=True).start()
+    threading.Thread(target=ingest_heartbeat, name="ingest-heartbeat", daemon=True).start()
+    yield
+    result_notifier.stop()
+    shutting_down.set()
+    ingest_executor.shutdown(wait=False, cancel_futures=True)
+    batch_executor.shutdown(wait=False, cancel_futures=True)
+    io_executor.shutdown(wait=False, cancel_futures=True)
+    shutdown_extraction_pool()
+    await async_redis.connection_pool.disconnect()
+    redis_client.connection_pool.disconnect()
+
 
 # Initialize FastAPI app
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 # Initialize Redis
 REDIS_HOST = os.getenv("REDIS_HOST")
 REDIS_PORT = int(os.getenv("REDIS_PORT", 6379))
 REDIS_PASSWORD = os.getenv("REDIS_PASSWORD")
+# Connection pool sizes: the sync pool serves background and I/O threads, the async one
+# the request handlers. Both block for a free connection instead of failing when exhausted
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", 64))
+REDIS_ASYNC_MAX_CONNECTIONS = int(os.getenv("REDIS_ASYNC_MAX_CONNECTIONS", 128))
 
 redis_client = redis.Redis(
-    host=REDIS_HOST,
-    port=REDIS_PORT,
-    password=REDIS_PASSWORD,
-    decode_responses=True
+    connection_pool=redis.BlockingConnectionPool(
+        host=REDIS_HOST,
+        port=REDIS_PORT,
+        password=REDIS_PASSWORD,
+        decode_responses=True,
+        max_connections=REDIS_MAX_CONNECTIONS
+    )
+)
+
+async_redis = aioredis.Redis(
+    connection_pool=aioredis.BlockingConnectionPool(
+        host=REDIS_HOST,
+        port=REDIS_PORT,
+        password=REDIS_PASSWORD,
+        decode_responses=True,
+        max_connections=REDIS_ASYNC_MAX_CONNECTIONS
+    )
 )
 
 try:
@@ -70,61 +267,420 @@ except redis.ConnectionError as e:
     logger.error(f"❌ Redis connection error: {e}")
 
 STREAM_NAME = "llm_requests"
+# How long one blocking read on a task's response stream waits before a keep-alive is sent
+STREAM_BLOCK_MS = int(os.getenv("STREAM_BLOCK_MS", 5000))
+# Workers publish finished task ids here; /wait_result/ holds requests open until then
+RESULT_CHANNEL = "task_results"
+RESULT_WAIT_MAX = float(os.getenv("RESULT_WAIT_MAX", 60))
+# How long document content stays in Redis for workers after its last use
+DOCUMENT_TTL = int(os.getenv("DOCUMENT_TTL", 7 * 24 * 3600))
+
+# Bump when the worker's prompts change so cached answers from old prompts are not reused
+PROMPT_VERSION = os.getenv("PROMPT_VERSION", "v2")
+RESULT_CACHE_STATS = "result_cache:stats"
+RESULT_CACHE_INDEX = "result_cache:index"
 
 # Storage directories
 UPLOAD_DIR = "uploads"
 MARKDOWN_DIR = "markdowns"
+INDEX_DIR = "indexes"
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 os.makedirs(MARKDOWN_DIR, exist_ok=True)
+os.makedirs(INDEX_DIR, exist_ok=True)
+
+# Local copies of S3 markdowns and indexes: revalidated against S3 every
+# DOCUMENT_CACHE_VALIDATE_INTERVAL seconds, evicted beyond DOCUMENT_CACHE_DISK_BYTES,
+# with the most-read documents also held in memory up to DOCUMENT_CACHE_HOT_BYTES
+DOCUMENT_CACHE_DISK_BYTES = int(os.getenv("DOCUMENT_CACHE_DISK_BYTES", 2 * 1024 ** 3))
+DOCUMENT_CACHE_HOT_BYTES = int(os.getenv("DOCUMENT_CACHE_HOT_BYTES", 64 * 1024 ** 2))
+DOCUMENT_CACHE_VALIDATE_INTERVAL = int(os.getenv("DOCUMENT_CACHE_VALIDATE_INTERVAL", 60))
+document_cache = DocumentCache(
+    s3_client,
+    S3_BUCKET_NAME,
+    disk_bytes=DOCUMENT_CACHE_DISK_BYTES,
+    hot_bytes=DOCUMENT_CACHE_HOT_BYTES,
+    validate_interval=DOCUMENT_CACHE_VALIDATE_INTERVAL
+)
+document_cache.adopt_directory(MARKDOWN_DIR, "new_upload/markdown")
+document_cache.adopt_directory(INDEX_DIR, "new_upload/index")
+
+# Models whose token counts are stored with each document, for the UI's cost estimates
+TOKEN_COUNT_MODELS = ("GPT-4o", "Gemini-Flash", "DeepSeek", "Claude", "Grok")
+# Markdown image links; workers strip them before prompting, so they are not counted
+IMAGE_LINK_PATTERN = re.compile(r"!\[[^\]]*\]\([^)]*\)\n?")
+
+# Q&A context: "vector" sends the top-k embedded chunks, "bm25" the best-matching
+# pages from the lexical index, "full" the whole document. Without a real embedding
+# model "bm25" is the default: the hashing embedder has no IDF and misses exact facts
+QA_RETRIEVAL = os.getenv("QA_RETRIEVAL", "bm25" if EMBEDDING_MODEL == HashingEmbedder.name else "vector")
+QA_TOP_K = int(os.getenv("QA_TOP_K", 5))
+QA_TOP_PAGES = int(os.getenv("QA_TOP_PAGES", 3))
+INDEX_CACHE_SIZE = int(os.getenv("INDEX_CACHE_SIZE", 16))
+
+# Set on shutdown; background loops (catalog reconcile, batch feeders) stop when they see it
+shutting_down = threading.Event()
+
+# Ingestion jobs: each one drives the shared extraction process pool from a thread
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", 2))
+INGEST_JOB_TTL = int(os.getenv("INGEST_JOB_TTL", 24 * 3600))
+ingest_executor = ThreadPoolExecutor(max_workers=INGEST_WORKERS, thread_name_prefix="ingest")
+# Jobs live only in the replica that accepted them. It refreshes their updated_at every
+# INGEST_HEARTBEAT_INTERVAL seconds; a queued or processing job not refreshed for
+# INGEST_STALE_AFTER seconds lost its replica and is reported as failed
+INGEST_HEARTBEAT_INTERVAL = int(os.getenv("INGEST_HEARTBEAT_INTERVAL", 10))
+INGEST_STALE_AFTER = int(os.getenv("INGEST_STALE_AFTER", 120))
+active_ingest_jobs = set()
+active_ingest_jobs_lock = threading.Lock()
+
+# Batch summarization: each batch is fed to the workers by one thread, keeping at most
+# BATCH_CONCURRENCY of its tasks queued or running so a large batch cannot flood the stream
+BATCH_WORKERS = int(os.getenv("BATCH_WORKERS", 2))
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", 8))
+BATCH_TTL = int(os.getenv("BATCH_TTL", 7 * 24 * 3600))
+# A batch task without a result this many seconds after it was queued is marked failed,
+# so a lost or stuck task cannot hold its batch open forever
+BATCH_TASK_TIMEOUT = int(os.getenv("BATCH_TASK_TIMEOUT", 30 * 60))
+batch_executor = ThreadPoolExecutor(max_workers=BATCH_WORKERS, thread_name_prefix="batch")
+
+# Catalog of processed markdowns: a sorted set with every score 0, so members sort by
+# name and prefix queries are ZRANGEBYLEX ranges. Uploads add to it; a background scan
+# of S3 reconciles it every CATALOG_RECONCILE_INTERVAL seconds
+CATALOG_KEY = "catalog:markdowns"
+CATALOG_RECONCILE_INTERVAL = int(os.getenv("CATALOG_RECONCILE_INTERVAL", 600))
+CATALOG_PAGE_SIZE = int(os.getenv("CATALOG_PAGE_SIZE", 100))
+CATALOG_MAX_PAGE_SIZE = 1000
+
+
+class ResultNotifier:
+    """Wakes requests waiting on task results, from one shared Redis subscription.
+
+    A background thread listens on RESULT_CHANNEL; each waiting request only
+    registers an asyncio event, so many clients can wait without holding a
+    Redis connection or polling.
+    """
+
+    def __init__(self):
+        self.waiters = defaultdict(set)
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self._listen, name="result-notifier", daemon=True).start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def _listen(self):
+        while not self.stopped.is_set():
+            try:
+                pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(RESULT_CHANNEL)
+                while not self.stopped.is_set():
+                    message = pubsub.get_message(timeout=1.0)
+                    if message:
+                        self._notify(message["data"])
+            except redis.ConnectionError as e:
+                logger.error(f"❌ Result notifier lost Redis: {e}")
+                # Messages may have been missed; let every waiter re-check its result
+                with self.lock:
+                    task_ids = list(self.waiters)
+                for task_id in task_ids:
+                    self._notify(task_id)
+                self.stopped.wait(1)
+
+    def _notify(self, task_id):
+        with self.lock:
+            waiters = self.waiters.pop(task_id, ())
+        for loop, event in waiters:
+            loop.call_soon_threadsafe(event.set)
+
+    async def wait(self, task_id: str, timeout: float):
+        """Return the task's result, waiting up to `timeout` seconds for it; None if still pending."""
+        event = asyncio.Event()
+        waiter = (asyncio.get_running_loop(), event)
+        # Register before checking, so a result stored in between still wakes us
+        with self.lock:
+            self.waiters[task_id].add(waiter)
+        try:
+            result = await async_redis.get(f"response:{task_id}")
+            if result:
+                return result
+            try:
+                await asyncio.wait_for(event.wait(), timeout)
+            except asyncio.TimeoutError:
+                return None
+            return await async_redis.get(f"response:{task_id}")
+        finally:
+            with self.lock:
+                self.waiters[task_id].discard(waiter)
+                if not self.waiters[task_id]:
+                    del self.waiters[task_id]
+
+
+result_notifier = ResultNotifier()
 
 
 @app.get("/")
 async def home():
     return {"message": "AI Document Processing API"}
 
-@app.post("/upload_pdf/")
-async def upload_pdf(file: UploadFile = File(...)):
+
+class MarkdownTee:
+    """Mirror for an S3MultipartWriter: copies the markdown to a local file and appends it to a Redis key.
+
+    Tokens per TOKEN_COUNT_MODELS are counted as the text passes, one run of
+    complete lines at a time with image links left out, so at most one
+    unfinished line is held besides the text being written.
+    """
+
+    def __init__(self, local_file, redis_key: str, ttl: int):
+        self.local_file = local_file
+        self.redis_key = redis_key
+        self.ttl = ttl
+        self.pending = ""
+        self.counters = [TokenCounter(model) for model in TOKEN_COUNT_MODELS]
+
+    def write(self, text: str) -> None:
+        self.local_file.write(text)
+        redis_client.pipeline().append(self.redis_key, text).expire(self.redis_key, self.ttl).execute()
+        lines = self.pending + text
+        cut = lines.rfind("\n") + 1
+        self._count(lines[:cut])
+        self.pending = lines[cut:]
+
+    def close(self) -> dict:
+        """Count the last line and return the token counts."""
+        self._count(self.pending)
+        self.pending = ""
+        return {counter.model: counter.total() for counter in self.counters}
+
+    def _count(self, text: str) -> None:
+        text = IMAGE_LINK_PATTERN.sub("", text)
+        if text:
+            for counter in self.counters:
+                counter.add(text)
+
+
+def ingest_pdf(pdf_source, md_filename: str, on_page=None) -> dict:
+    """Extract the PDF (a path or BytesIO) into markdown, upload it to S3 and cache the text in Redis.
+
+    The markdown is written to the local file, streamed to S3 part by part
+    and appended to Redis as pages are extracted, so memory stays bounded by
+    a page rather than the document. Blocking: page extraction waits on the
+    process pool and the S3/Redis calls are synchronous, so call it from a
+    worker thread. `on_page` is called with each page number once that page
+    has been written.
+    """
+    md_path = os.path.join(MARKDOWN_DIR, md_filename)
+    # Text and markdown are appended under staging keys and renamed into place once complete
+    staging_id = os.urandom(4).hex()
+    text_staging_key = f"staging:extracted_text:{md_filename}:{staging_id}"
+    document_staging_key = f"staging:document:{md_filename}:{staging_id}"
+
+    # ✅ Stream pages from OpenSourcePDF straight into the Markdown file and Redis
+    extracted = {"pages": 0, "chars": 0}
+    chunks = []
+    bm25_index = BM25Index()
+    image_stats = new_image_stats()
+
+    def collect_text(pages):
+        for page in pages:
+            extracted["pages"] += 1
+            extracted["chars"] += len(page["text"])
+            redis_client.pipeline().append(text_staging_key, page["text"]).expire(text_staging_key, 3600).execute()
+            if QA_RETRIEVAL == "vector":
+                chunks.extend(chunk_page(page["page"], page["text"]))
+            bm25_index.add_page(page["page"], page["text"])
+            yield page
+            if on_page:
+                on_page(page["page"])
+
+    image_store = s3_image_store() if IMAGE_STORAGE == "s3" else None
     try:
-        contents = await file.read()
-        pdf_file_io = io.BytesIO(contents)
+        # ✅ Markdown goes to the local file, Redis and, part by part, S3; the upload is aborted if extraction fails
+        with open(md_path, "w", encoding="utf-8") as md_file:
+            mirror = MarkdownTee(md_file, document_staging_key, 3600)
+            with S3MultipartWriter("new_upload/markdown", md_filename, "text/markdown", mirror=mirror) as md_upload:
+                save_to_md(
+                    collect_text(iter_pages(pdf_source, image_stats=image_stats)),
+                    sink=md_upload,
+                    image_store=image_store
+                )
 
-        # ✅ Use OpenSourcePDF to extract text, images, and tables
-        extracted_data = extract_data(pdf_file_io)
+                if not extracted["pages"]:
+                    raise HTTPException(status_code=400, detail="❌ No Extracted Data Found in the PDF")
+                if not extracted["chars"]:
+                    raise HTTPException(status_code=400, detail="❌ No text extracted from PDF.")
+    except BaseException:
+        redis_client.delete(text_staging_key, document_staging_key)
+        raise
 
-        if extracted_data:
-            # ✅ Convert extracted data to Markdown format
-            markdown_content = save_to_md(extracted_data)
+    document_cache.put(f"new_upload/markdown/{md_filename}", md_path, md_upload.etag)
+    logger.info(f"🖼️ Image extraction for {md_filename}: {image_stats}")
 
-            # ✅ Generate Markdown filename (same as the original PDF)
-            md_filename = file.filename.replace(".pdf", ".md")
+    # ✅ Store extracted text in Redis for 1 hour (the TTL moves with the key)
+    redis_client.rename(text_staging_key, f"extracted_text:{md_filename}")
 
-            # ✅ Upload Markdown file to S3
-            upload_to_s3(markdown_content.encode(), "new_upload/markdown", md_filename, "text/markdown")
+    # ✅ Publish the markdown under the hash computed while uploading it, so LLM tasks can reference it
+    publish_staged_document(md_filename, document_staging_key, md_upload.sha256.hexdigest())
 
-            # ✅ Extract text from extracted_data
-            extracted_text = extracted_data.get("text", "")
+    # ✅ Record page, size and token statistics so clients never download the file to count tokens
+    save_document_stats(md_filename, extracted["pages"], os.path.getsize(md_path), mirror.close())
 
-            # ✅ Store extracted text in Redis for 1 hour
-            if extracted_text:
-                redis_client.set(f"extracted_text:{md_filename}", extracted_text, ex=3600)
-            else:
-                raise HTTPException(status_code=400, detail="❌ No text extracted from PDF.")
+    # ✅ Embed the page chunks when Q&A retrieves by vector
+    if QA_RETRIEVAL == "vector":
+        index_bytes = VectorIndex.build(chunks).to_bytes()
+        index_filename = vector_index_filename(md_filename)
+        index_path = os.path.join(INDEX_DIR, index_filename)
+        with open(index_path, "wb") as index_file:
+            index_file.write(index_bytes)
+        index_etag = upload_to_s3(index_bytes, "new_upload/index", index_filename, "application/octet-stream")
+        document_cache.put(f"new_upload/index/{index_filename}", index_path, index_etag)
 
-            return {
-                "message": "✅ Successfully processed the PDF and saved to S3.",
-                "filename": md_filename,
-                "s3_url": f"https://{S3_BUCKET_NAME}.s3.{S3_REGION}.amazonaws.com/new_upload/markdown/{md_filename}"
-            }
-        else:
-            raise HTTPException(status_code=400, detail="❌ No Extracted Data Found in the PDF")
+    # ✅ Persist the BM25 page index next to the markdown
+    bm25_bytes = bm25_index.to_bytes()
+    bm25_name = bm25_filename(md_filename)
+    bm25_path = os.path.join(MARKDOWN_DIR, bm25_name)
+    with open(bm25_path, "wb") as bm25_file:
+        bm25_file.write(bm25_bytes)
+    bm25_etag = upload_to_s3(bm25_bytes, "new_upload/markdown", bm25_name, "application/octet-stream")
+    document_cache.put(f"new_upload/markdown/{bm25_name}", bm25_path, bm25_etag)
+
+    # ✅ List the document only once everything it needs is stored
+    redis_client.zadd(CATALOG_KEY, {md_filename: 0})
+
+    return {"image_stats": image_stats}
+
+
+def run_ingest_job(job_id: str, pdf_path: str, pdf_filename: str, md_filename: str) -> None:
+    """Ingestion job body: store the raw PDF in S3, then extract it, reporting per-page progress.
+
+    The PDF stays on disk throughout: it is uploaded with a parallel multipart
+    transfer and extracted from its path.
+    """
+    job_key = f"ingest:{job_id}"
+    try:
+        redis_client.hset(job_key, mapping={
+            "status": "processing",
+            "page_count": count_pages(pdf_path),
+            "updated_at": time.time()
+        })
+        upload_file_to_s3(pdf_path, "new_upload/pdf", pdf_filename, "application/pdf")
+
+        result = ingest_pdf(
+            pdf_path,
+            md_filename,
+            on_page=lambda page_num: redis_client.hset(job_key, mapping={"pages_done": page_num, "updated_at": time.time()})
+        )
+
+        redis_client.hset(job_key, mapping={
+            "status": "done",
+            "image_stats": json.dumps(result["image_stats"]),
+            "updated_at": time.time()
+        })
+        logger.info(f"✅ Ingestion job {job_id} finished for {md_filename}")
+    except Exception as e:
+        detail = e.detail if isinstance(e, HTTPException) else str(e)
+        redis_client.hset(job_key, mapping={"status": "failed", "error": detail, "updated_at": time.time()})
+        logger.error(f"❌ Ingestion job {job_id} failed: {detail}")
+    finally:
+        with active_ingest_jobs_lock:
+            active_ingest_jobs.discard(job_id)
+        if os.path.exists(pdf_path):
+            os.remove(pdf_path)
+
+
+def ingest_heartbeat() -> None:
+    """Refresh updated_at on the jobs this replica holds, so their status can tell when it is gone."""
+    while not shutting_down.wait(INGEST_HEARTBEAT_INTERVAL):
+        with active_ingest_jobs_lock:
+            job_ids = list(active_ingest_jobs)
+        if not job_ids:
+            continue
+        try:
+            pipe = redis_client.pipeline()
+            for job_id in job_ids:
+                pipe.hset(f"ingest:{job_id}", "updated_at", time.time())
+            pipe.execute()
+        except Exception as e:
+            logger.error(f"❌ Ingestion heartbeat failed: {e}")
+
+
+def spool_upload(upload, path: str) -> None:
+    """Copy an uploaded file to `path` block by block, never holding all of it in memory."""
+    upload.seek(0)
+    with open(path, "wb") as output_file:
+        shutil.copyfileobj(upload, output_file, UPLOAD_CHUNK_SIZE)
+
+
+@app.post("/upload_pdf/")
+async def upload_pdf(file: UploadFile = File(...)):
+    """Spool the raw PDF to disk and queue an ingestion job; poll /ingest_status/{job_id} for progress."""
+    try:
+        # ✅ Generate Markdown filename (same as the original PDF)
+        md_filename = file.filename.replace(".pdf", ".md")
+
+        job_id = f"ingest-{os.urandom(4).hex()}"
+        pdf_path = os.path.join(UPLOAD_DIR, f"{job_id}.pdf")
+        await run_blocking(spool_upload, file.file, pdf_path)
+
+        job_key = f"ingest:{job_id}"
+        await async_redis.hset(job_key, mapping={
+            "status": "queued",
+            "filename": md_filename,
+            "pages_done": 0,
+            "page_count": 0,
+            "updated_at": time.time()
+        })
+        await async_redis.expire(job_key, INGEST_JOB_TTL)
+
+        # ✅ Extraction runs in the ingest pool; the request returns right away
+        with active_ingest_jobs_lock:
+            active_ingest_jobs.add(job_id)
+        ingest_executor.submit(run_ingest_job, job_id, pdf_path, file.filename, md_filename)
+
+        return {
+            "message": "✅ PDF received, extraction started.",
+            "job_id": job_id,
+            "filename": md_filename,
+            "s3_url": f"https://{S3_BUCKET_NAME}.s3.{S3_REGION}.amazonaws.com/new_upload/markdown/{md_filename}"
+        }
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+
+@app.get("/ingest_status/{job_id}")
+async def ingest_status(job_id: str):
+    """Report the state and per-page progress of an ingestion job."""
+    job_key = f"ingest:{job_id}"
+    job = await async_redis.hgetall(job_key)
+    if not job:
+        raise HTTPException(status_code=404, detail="⚠️ Ingestion job not found.")
+
+    if job["status"] in ("queued", "processing") and time.time() - float(job.get("updated_at", "inf")) > INGEST_STALE_AFTER:
+        # The replica running the job stopped refreshing it, e.g. it was restarted or scaled down
+        job["status"] = "failed"
+        job["error"] = "Ingestion was interrupted before it finished; please upload the PDF again."
+        await async_redis.hset(job_key, mapping={"status": job["status"], "error": job["error"]})
+
+    status = {
+        "job_id": job_id,
+        "status": job["status"],
+        "filename": job["filename"],
+        "pages_done": int(job.get("pages_done", 0)),
+        "page_count": int(job.get("page_count", 0))
+    }
+    if "error" in job:
+        status["error"] = job["error"]
+    if "image_stats" in job:
+        status["image_stats"] = json.loads(job["image_stats"])
+    return status
+
 @app.get("/get_extracted_text/{filename}")
 async def get_extracted_text(filename: str):
     """Fetch extracted text from Redis."""
-    extracted_text = redis_client.get(f"extracted_text:{filename}")
+    extracted_text = await async_redis.get(f"extracted_text:{filename}")
 
     if extracted_text:
         return {"extracted_text": extracted_text}  # ✅ No need to decode
@@ -134,108 +690,574 @@ async def get_extracted_text(filename: str):
 
 
 
+async def catalog_page(prefix: str = "", cursor: str = None, limit: int = CATALOG_PAGE_SIZE):
+    """Up to `limit` catalogued names starting with `prefix` and sorting after `cursor`.
+
+    Returns the names and the cursor for the next page (None on the last page).
+    """
+    if cursor and cursor >= prefix:
+        low = f"({cursor}"
+    else:
+        low = f"[{prefix}" if prefix else "-"
+    # Names sort bytewise, so prefix + 0xff bounds every name that starts with the prefix
+    high = b"[" + prefix.encode("utf-8") + b"\xff" if prefix else "+"
+    names = await async_redis.zrangebylex(CATALOG_KEY, low, high, start=0, num=limit + 1)
+    if len(names) > limit:
+        return names[:limit], names[limit - 1]
+    return names, None
+
+
+def reconcile_catalog() -> None:
+    """Bring the catalog in line with the markdown files in S3, paging through every key."""
+    catalogued = set(redis_client.zrange(CATALOG_KEY, 0, -1))
+    found = set()
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=S3_BUCKET_NAME, Prefix="new_upload/markdown/"):
+        names = [obj["Key"].split("/")[-1] for obj in page.get("Contents", []) if obj["Key"].endswith(".md")]
+        if names:
+            redis_client.zadd(CATALOG_KEY, {name: 0 for name in names})
+            found.update(names)
+
+    # Only drop names catalogued before the scan started; later ones come from uploads made meanwhile
+    removed = catalogued - found
+    if removed:
+        redis_client.zrem(CATALOG_KEY, *removed)
+    logger.info(f"📚 Catalog reconciled: {len(found)} markdown files in S3, {len(removed)} removed")
+
+
+def catalog_reconciler() -> None:
+    while True:
+        try:
+            reconcile_catalog()
+        except Exception as e:
+            logger.error(f"❌ Catalog reconcile failed: {e}")
+        if shutting_down.wait(CATALOG_RECONCILE_INTERVAL):
+            return
+
+
 @app.get("/select_pdfcontent/")
-async def get_markdowns():
-    """Retrieve the list of Markdown files stored in S3."""
+async def get_markdowns(prefix: str = "", cursor: str = None, limit: int = CATALOG_PAGE_SIZE):
+    """List processed Markdown files from the catalog, by name prefix, one page at a time.
+
+    Pass the returned `next_cursor` back as `cursor` for the following page.
+    """
     try:
-        response = s3_client.list_objects_v2(Bucket=S3_BUCKET_NAME, Prefix="")
+        markdown_files, next_cursor = await catalog_page(prefix, cursor, min(max(limit, 1), CATALOG_MAX_PAGE_SIZE))
+        return {"markdowns": markdown_files, "next_cursor": next_cursor}
 
-        if "Contents" not in response:
-            return {"markdowns": []}  # No files found
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"❌ Failed to list Markdown files: {str(e)}")
 
-        markdown_files = [
-            obj["Key"].split("/")[-1] for obj in response["Contents"] if obj["Key"].endswith(".md")
-        ]
 
-        return {"markdowns": markdown_files}
+class CachedFileResponse(FileResponse):
+    """A FileResponse for a document cache file, which stays on disk until the response is over."""
 
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"❌ Failed to list Markdown files from S3: {str(e)}")
+    def __init__(self, cache_key: str, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cache_key = cache_key
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            document_cache.release(self.cache_key)
 
 
 @app.get("/download_markdown/{filename}")
 async def download_markdown(filename: str):
-    """Download the extracted markdown file."""
-    file_path = os.path.join(MARKDOWN_DIR, filename)
-    if os.path.exists(file_path):
-        return FileResponse(file_path, filename=filename)
-    return JSONResponse(content={"error": "File not found"}, status_code=404)
-def read_file_content(file_path):
-    """Reads and returns the content of a markdown file."""
-    if not os.path.exists(file_path):
-        raise HTTPException(status_code=404, detail=f"❌ Error: File {file_path} not found.")
-
-    with open(file_path, "r", encoding="utf-8") as file:
-        content = file.read().strip()
-
-    if not content:
-        raise HTTPException(status_code=400, detail=f"❌ Error: {file_path} is empty.")
+    """Download the extracted markdown file; streamed in chunks, with HTTP Range support."""
+    key = f"new_upload/markdown/{filename}"
+    try:
+        file_path = await run_blocking(document_cache.acquire, key, os.path.join(MARKDOWN_DIR, filename))
+    except FileNotFoundError:
+        return JSONResponse(content={"error": "File not found"}, status_code=404)
+    return CachedFileResponse(key, file_path, filename=filename, media_type="text/markdown")
 
-    return content
-@app.post("/summarize/")
-async def summarize(pdf_name: str = Form(...), llm: str = Form(...)):
-    """Download file from S3 if not available locally, then process it."""
-    file_path = os.path.join(MARKDOWN_DIR, pdf_name)
 
-    # ✅ Check if file exists in the local directory
-    if not os.path.exists(file_path):
-        try:
-            # ✅ Try downloading from S3 if missing locally
-            s3_client.download_file(S3_BUCKET_NAME, f"new_upload/markdown/{pdf_name}", file_path)
-        except Exception as e:
-            raise HTTPException(status_code=404, detail=f"❌ Error: Could not download {pdf_name} from S3. {str(e)}")
+def document_stats(md_filename: str, content: str, size: int) -> dict:
+    """Compute and store a document's page count, byte size and token count per model."""
+    prompt_text = IMAGE_LINK_PATTERN.sub("", content).strip()
+    tokens = {model: count_tokens(prompt_text, model) for model in TOKEN_COUNT_MODELS}
+    return save_document_stats(md_filename, len(split_page_sections(content)), size, tokens)
+
 
-    # ✅ Read file content
+def save_document_stats(md_filename: str, pages: int, size: int, tokens: dict) -> dict:
+    stats = {"filename": md_filename, "pages": pages, "bytes": size, "tokens": tokens}
+    redis_client.set(f"doc_stats:{md_filename}", json.dumps(stats))
+    return stats
+
+
+@app.get("/document_metadata/{filename}")
+async def document_metadata(filename: str):
+    """Page count, byte size and per-model token counts of a processed markdown, computed at ingest."""
+    stats = await async_redis.get(f"doc_stats:{filename}")
+    if stats:
+        return json.loads(stats)
+
+    # Documents ingested before statistics were kept get them computed once, here
+    return await run_blocking(compute_document_stats, filename)
+
+
+def compute_document_stats(filename: str) -> dict:
     try:
-        with open(file_path, "r", encoding="utf-8") as file:
-            file_content = file.read()
+        data = read_markdown(filename)
     except FileNotFoundError:
-        raise HTTPException(status_code=404, detail=f"❌ Error: File {pdf_name} not found.")
+        raise HTTPException(status_code=404, detail="⚠️ Document not found.")
+    return document_stats(filename, markdown_text(filename, data), len(data))
+
+
+def read_markdown(filename: str) -> bytes:
+    """A processed markdown's bytes, from memory when it is hot, else from disk or S3."""
+    return document_cache.read_bytes(f"new_upload/markdown/{filename}", os.path.join(MARKDOWN_DIR, filename))
+
+
+def markdown_text(filename: str, data: bytes) -> str:
+    """Decoded markdown content, unstripped so it hashes as it did at upload; an empty document is a 400."""
+    content = data.decode("utf-8")
+    if not content.strip():
+        raise HTTPException(status_code=400, detail=f"❌ Error: {filename} is empty.")
+    return content
+
+
+def publish_document(md_filename: str, content: str) -> str:
+    """Store markdown content in Redis under its SHA-256 and map the filename to it.
+
+    Workers resolve task content from `document:{hash}`, so each document
+    crosses Redis once instead of once per request.
+    """
+    content_hash = hashlib.sha256(content.encode("utf-8")).hexdigest()
+    document_key = f"document:{content_hash}"
+    if not redis_client.set(document_key, content, ex=DOCUMENT_TTL, nx=True):
+        redis_client.expire(document_key, DOCUMENT_TTL)
+    redis_client.set(f"doc_hash:{md_filename}", content_hash)
+    return content_hash
+
+
+def publish_staged_document(md_filename: str, staging_key: str, content_hash: str) -> str:
+    """Like `publish_document`, for content already appended to `staging_key` and hashed while written."""
+    document_key = f"document:{content_hash}"
+    if not redis_client.renamenx(staging_key, document_key):
+        redis_client.delete(staging_key)
+    redis_client.expire(document_key, DOCUMENT_TTL)
+    redis_client.set(f"doc_hash:{md_filename}", content_hash)
+    return content_hash
+
+
+def document_ref(pdf_name: str) -> str:
+    """Return the content hash for a processed markdown, publishing it if Redis no longer has it."""
+    content_hash = redis_client.get(f"doc_hash:{pdf_name}")
+    # ✅ expire() doubles as an existence check and keeps hot documents alive
+    if content_hash and redis_client.expire(f"document:{content_hash}", DOCUMENT_TTL):
+        return content_hash
+
+    # ✅ Read through the document cache, which fetches from S3 when the local copy is missing or stale
+    try:
+        data = read_markdown(pdf_name)
+    except Exception as e:
+        raise HTTPException(status_code=404, detail=f"❌ Error: Could not download {pdf_name} from S3. {str(e)}")
+
+    return publish_document(pdf_name, markdown_text(pdf_name, data))
+
 
-    if not file_content.strip():
-        raise HTTPException(status_code=400, detail=f"❌ Error: {pdf_name} is empty.")
+def result_cache_key(content_hash: str, task_type: str, llm: str, question: str = "", context: list = None) -> str:
+    """Key for a cached LLM result; questions are compared case- and whitespace-insensitively.
+
+    Q&A keys include the retrieved `context` (None for the whole document), so
+    a change of retrieval mode, depth or index never serves an answer built
+    from other excerpts.
+    """
+    normalized_question = " ".join(question.lower().split())
+    raw_key = "\x1f".join([
+        content_hash, task_type, llm, normalized_question, PROMPT_VERSION, json.dumps(context, sort_keys=True)
+    ])
+    return f"result_cache:{hashlib.sha256(raw_key.encode('utf-8')).hexdigest()}"
+
+
+def enqueue_task(task: dict, cache_key: str) -> dict:
+    """Answer from the result cache when possible, otherwise queue the task for the workers.
+
+    A cache hit is written to `response:{task_id}` straight away, so clients
+    fetch it the same way as a worker result.
+    """
+    cached = redis_client.get(cache_key)
+    redis_client.hincrby(RESULT_CACHE_STATS, "api_hits" if cached else "api_misses", 1)
+
+    if cached:
+        redis_client.set(f"response:{task['task_id']}", cached)
+        logger.info(f"⚡ Cache hit for task {task['task_id']} ({task['type']})")
+        return {"task_id": task["task_id"], "cached": True}
+
+    task_data = json.dumps({**task, "cache_key": cache_key, "prompt_version": PROMPT_VERSION})
+    redis_client.xadd(STREAM_NAME, {"data": task_data})
+    return {"task_id": task["task_id"], "cached": False}
+
+
+def vector_index_filename(md_filename: str) -> str:
+    return f"{os.path.splitext(md_filename)[0]}.vectors.npz"
+
+
+def load_vector_index(pdf_name: str, content_hash: str):
+    """Load a document's chunk index from disk or S3; None if it was ingested without one.
+
+    The index bytes of frequently asked documents stay in the document cache's
+    memory tier, which also notices when a re-ingested document replaces them.
+    """
+    index_filename = vector_index_filename(pdf_name)
+    try:
+        data = document_cache.read_bytes(f"new_upload/index/{index_filename}", os.path.join(INDEX_DIR, index_filename))
+    except Exception:
+        return None
+    return VectorIndex.from_bytes(data)
+
+
+def bm25_filename(md_filename: str) -> str:
+    return f"{os.path.splitext(md_filename)[0]}.bm25"
+
+
+def load_bm25_index(pdf_name: str, content_hash: str):
+    """Load a document's BM25 page index from disk or S3; None if it was ingested without one."""
+    bm25_name = bm25_filename(pdf_name)
+    try:
+        data = document_cache.read_bytes(f"new_upload/markdown/{bm25_name}", os.path.join(MARKDOWN_DIR, bm25_name))
+    except Exception:
+        return None
+    return BM25Index.from_bytes(data)
+
+
+@lru_cache(maxsize=INDEX_CACHE_SIZE)
+def load_page_sections(content_hash: str) -> dict:
+    """Page texts of a published document, keyed by page number."""
+    return split_page_sections(redis_client.get(f"document:{content_hash}") or "")
+
+
+def retrieve_context(pdf_name: str, content_hash: str, question: str):
+    """Relevant excerpts for the question as `{"page", "text"}` dicts, or None to send the whole document.
+
+    In "vector" mode, a document without a usable vector index falls back to
+    its BM25 index, then to the whole document.
+    """
+    if QA_RETRIEVAL == "vector":
+        index = load_vector_index(pdf_name, content_hash)
+        if index is not None:
+            try:
+                return [{"page": page_num, "text": text} for _, page_num, text in index.search(question, QA_TOP_K)]
+            except ValueError as e:
+                logger.warning(f"⚠️ Vector index of {pdf_name} cannot be searched here, using BM25: {e}")
+
+    if QA_RETRIEVAL in ("vector", "bm25"):
+        index = load_bm25_index(pdf_name, content_hash)
+        if index is None:
+            return None
+        pages = load_page_sections(content_hash)
+        return [
+            {"page": page_num, "text": pages[page_num]}
+            for page_num, _ in index.search(question, QA_TOP_PAGES) if page_num in pages
+        ]
+
+    return None
+
+
+def queue_summary(pdf_name: str, llm: str) -> dict:
+    """Queue a summarization task that references the document by content hash."""
+    content_hash = document_ref(pdf_name)
 
     task_id = f"task-{os.urandom(4).hex()}"
 
-    # ✅ Send file content to Redis for processing
-    task_data = json.dumps({
+    # ✅ Send a document reference to Redis for processing
+    return enqueue_task({
         "task_id": task_id,
         "type": "summarize",
         "pdf_name": pdf_name,
         "llm": llm,
-        "content": file_content  # ✅ Sending the actual text
+        "content_hash": content_hash
+    }, result_cache_key(content_hash, "summarize", llm))
+
+
+@app.post("/summarize/")
+async def summarize(pdf_name: str = Form(...), llm: str = Form(...)):
+    """Queue a summarization task that references the document by content hash."""
+    result = await run_blocking(queue_summary, pdf_name, llm)
+    return {**result, "message": "✅ Summarization request added"}
+
+
+async def list_markdowns(prefix: str) -> List[str]:
+    """Names of every catalogued markdown file whose name starts with `prefix`."""
+    names, cursor = await catalog_page(prefix, limit=CATALOG_MAX_PAGE_SIZE)
+    while cursor:
+        page, cursor = await catalog_page(prefix, cursor, CATALOG_MAX_PAGE_SIZE)
+        names.extend(page)
+    return names
+
+
+def run_batch(batch_id: str, pdf_names: List[str], llm: str) -> None:
+    """Batch job body: queue one summary per document, at most BATCH_CONCURRENCY at a time.
+
+    Finished tasks are noticed through the workers' RESULT_CHANNEL
+    announcements, with a one-second re-check in case one was missed. A task
+    still without a result after BATCH_TASK_TIMEOUT seconds is marked failed.
+    """
+    batch_key = f"batch:{batch_id}"
+    tasks_key = f"batch:{batch_id}:tasks"
+    pending = deque(pdf_names)
+    in_flight = {}
+
+    # Subscribe before queueing anything, so no completion can be missed
+    pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(RESULT_CHANNEL)
+    redis_client.hset(batch_key, mapping={"status": "processing", "started_at": time.time()})
+    try:
+        while (pending or in_flight) and not shutting_down.is_set():
+            while pending and len(in_flight) < BATCH_CONCURRENCY:
+                pdf_name = pending.popleft()
+                try:
+                    task_id = queue_summary(pdf_name, llm)["task_id"]
+                except HTTPException as e:
+                    redis_client.hset(tasks_key, pdf_name, json.dumps({"error": e.detail}))
+                    redis_client.hincrby(batch_key, "failed", 1)
+                    continue
+                redis_client.hset(tasks_key, pdf_name, json.dumps({"task_id": task_id}))
+                in_flight[task_id] = (pdf_name, time.monotonic() + BATCH_TASK_TIMEOUT)
+
+            if not in_flight:
+                continue
+            pubsub.get_message(timeout=1.0)
+
+            task_ids = list(in_flight)
+            now = time.monotonic()
+            for task_id, result in zip(task_ids, redis_client.mget([f"response:{task_id}" for task_id in task_ids])):
+                pdf_name, deadline = in_flight[task_id]
+                if result is None and now < deadline:
+                    continue
+                del in_flight[task_id]
+                if result is None:
+                    # A result arriving later is ignored; the batch no longer waits for it
+                    redis_client.hset(tasks_key, pdf_name, json.dumps({
+                        "task_id": task_id,
+                        "error": f"❌ Timed out after {BATCH_TASK_TIMEOUT} seconds."
+                    }))
+                    redis_client.hincrby(batch_key, "failed", 1)
+                    logger.warning(f"⚠️ Batch {batch_id}: task {task_id} for {pdf_name} timed out")
+                else:
+                    redis_client.hincrby(batch_key, "failed" if result.startswith("❌") else "completed", 1)
+
+        if pending or in_flight:
+            # Interrupted by shutdown; tasks already queued still finish on the workers
+            redis_client.hset(batch_key, mapping={"status": "interrupted", "finished_at": time.time()})
+            logger.warning(f"⚠️ Batch {batch_id} interrupted with {len(pending)} documents not queued")
+        else:
+            redis_client.hset(batch_key, mapping={"status": "done", "finished_at": time.time()})
+            logger.info(f"✅ Batch {batch_id} finished ({len(pdf_names)} documents)")
+    except Exception as e:
+        redis_client.hset(batch_key, mapping={"status": "failed", "error": str(e), "finished_at": time.time()})
+        logger.error(f"❌ Batch {batch_id} failed: {e}")
+    finally:
+        pubsub.close()
+        redis_client.expire(batch_key, BATCH_TTL)
+        redis_client.expire(tasks_key, BATCH_TTL)
+
+
+@app.post("/summarize_batch/")
+async def summarize_batch(llm: str = Form(...), pdf_names: List[str] = Form(None), prefix: str = Form(None)):
+    """Summarize many markdown documents, named explicitly or by name prefix; returns a batch id.
+
+    Follow progress at /batch_status/{batch_id} and fetch every summary at once
+    from /batch_result/{batch_id}.
+    """
+    if pdf_names is None and prefix is None:
+        raise HTTPException(status_code=400, detail="⚠️ Provide pdf_names or prefix.")
+
+    if pdf_names is None:
+        try:
+            pdf_names = await list_markdowns(prefix)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"❌ Failed to list Markdown files: {str(e)}")
+    # Keep the caller's order but summarize each document once
+    pdf_names = list(dict.fromkeys(pdf_names))
+    if not pdf_names:
+        raise HTTPException(status_code=404, detail="⚠️ No markdown files matched.")
+
+    batch_id = f"batch-{os.urandom(4).hex()}"
+    batch_key = f"batch:{batch_id}"
+    await async_redis.hset(batch_key, mapping={
+        "status": "queued",
+        "llm": llm,
+        "documents": json.dumps(pdf_names),
+        "total": len(pdf_names),
+        "completed": 0,
+        "failed": 0,
+        "created_at": time.time()
     })
+    await async_redis.expire(batch_key, BATCH_TTL)
 
-    redis_client.xadd(STREAM_NAME, {"data": task_data})
-    return {"task_id": task_id, "message": "✅ Summarization request added"}
+    batch_executor.submit(run_batch, batch_id, pdf_names, llm)
 
+    return {"batch_id": batch_id, "total": len(pdf_names), "message": "✅ Batch summarization started"}
 
-@app.post("/ask_question/")
-async def ask_question(pdf_name: str = Form(...), llm: str = Form(...), question: str = Form(...)):
-    """Send a question-answering request with document content to Redis."""
-    file_path = os.path.join(MARKDOWN_DIR, pdf_name)
-    content = read_file_content(file_path)  # ✅ Read file content before sending to Redis
+
+@app.get("/batch_status/{batch_id}")
+async def batch_status(batch_id: str):
+    """Aggregate progress of a batch, with throughput in documents per minute and an ETA."""
+    batch = await async_redis.hgetall(f"batch:{batch_id}")
+    if not batch:
+        raise HTTPException(status_code=404, detail="⚠️ Batch not found.")
+
+    total = int(batch["total"])
+    finished = int(batch["completed"]) + int(batch["failed"])
+    status = {
+        "batch_id": batch_id,
+        "status": batch["status"],
+        "llm": batch["llm"],
+        "total": total,
+        "completed": int(batch["completed"]),
+        "failed": int(batch["failed"]),
+        "remaining": total - finished
+    }
+    if "started_at" in batch:
+        elapsed = float(batch.get("finished_at", time.time())) - float(batch["started_at"])
+        status["elapsed_seconds"] = round(elapsed, 1)
+        if finished and elapsed > 0:
+            status["docs_per_minute"] = round(finished / elapsed * 60, 2)
+            status["eta_seconds"] = round((total - finished) * elapsed / finished, 1)
+    if "error" in batch:
+        status["error"] = batch["error"]
+    return status
+
+
+async def batch_summaries(pdf_names: List[str], tasks: dict):
+    """Render a batch's summaries as one markdown document, a section per file, fetching results in slices."""
+    for start in range(0, len(pdf_names), 100):
+        names = pdf_names[start:start + 100]
+        entries = [json.loads(tasks[name]) if name in tasks else {} for name in names]
+        task_ids = [entry["task_id"] for entry in entries if "task_id" in entry]
+        results = dict(zip(task_ids, await async_redis.mget([f"response:{task_id}" for task_id in task_ids]))) if task_ids else {}
+
+        for name, entry in zip(names, entries):
+            if "error" in entry:
+                body = entry["error"]
+            else:
+                body = results.get(entry.get("task_id")) or "_Pending..._"
+            yield f"## {name}\n\n{body}\n\n"
+
+
+@app.get("/batch_result/{batch_id}")
+async def batch_result(batch_id: str):
+    """Download every summary of a batch as a single markdown file."""
+    documents = await async_redis.hget(f"batch:{batch_id}", "documents")
+    if documents is None:
+        raise HTTPException(status_code=404, detail="⚠️ Batch not found.")
+
+    tasks = await async_redis.hgetall(f"batch:{batch_id}:tasks")
+    return StreamingResponse(
+        batch_summaries(json.loads(documents), tasks),
+        media_type="text/markdown",
+        headers={"Content-Disposition": f'attachment; filename="{batch_id}.md"'}
+    )
+
+
+def queue_question(pdf_name: str, llm: str, question: str) -> dict:
+    """Queue a question-answering task that references the document by content hash."""
+    content_hash = document_ref(pdf_name)
 
     task_id = f"task-{os.urandom(4).hex()}"
 
-    task_data = json.dumps({
+    task = {
         "task_id": task_id,
         "type": "qa",
         "pdf_name": pdf_name,
         "llm": llm,
         "question": question,
-        "content": content  # ✅ Send actual content
-    })
+        "content_hash": content_hash
+    }
 
-    redis_client.xadd(STREAM_NAME, {"data": task_data})
-    return {"task_id": task_id, "message": "✅ Q&A request added"}
+    # ✅ Send only the most relevant excerpts when the document has a retrieval index
+    context = retrieve_context(pdf_name, content_hash, question)
+    if context:
+        task["context"] = context
+
+    return enqueue_task(task, result_cache_key(content_hash, "qa", llm, question, context or None))
+
+
+@app.post("/ask_question/")
+async def ask_question(pdf_name: str = Form(...), llm: str = Form(...), question: str = Form(...)):
+    """Queue a question-answering task, sending the most relevant excerpts when the document is indexed."""
+    # Retrieval may fetch indexes from S3 and embed the question, so it runs off the event loop
+    result = await run_blocking(queue_question, pdf_name, llm, question)
+    return {**result, "message": "✅ Q&A request added"}
 
 
 @app.get("/get_result/{task_id}")
 async def get_result(task_id: str):
     """Fetch the result of an AI task."""
-    result = redis_client.get(f"response:{task_id}")
+    result = await async_redis.get(f"response:{task_id}")
     if result:
         return {"result": result}
     return JSONResponse(content={"message": "Processing..."}, status_code=202)
 
+
+@app.get("/wait_result/{task_id}")
+async def wait_result(task_id: str, timeout: float = 30):
+    """Long-poll for the result of an AI task: returns as soon as it is stored, or 202 after `timeout` seconds."""
+    result = await result_notifier.wait(task_id, min(max(timeout, 0), RESULT_WAIT_MAX))
+    if result:
+        return {"result": result}
+    return JSONResponse(content={"message": "Processing..."}, status_code=202)
+
+
+async def result_events(task_id: str, timeout: float):
+    """Server-sent events for a task: one `data` event per text delta, then a `done` event.
+
+    Tails the worker's `response_stream:{task_id}` with blocking XREAD. Results
+    that never went through a stream (cache hits answered by the API) are sent
+    as a single delta. When a task is re-run after deltas were sent, a `reset`
+    event tells the client to discard them.
+    """
+    stream_key = f"response_stream:{task_id}"
+    last_id = "0-0"
+    sent_deltas = False
+    deadline = time.monotonic() + timeout
+
+    while time.monotonic() < deadline:
+        if last_id == "0-0" and not await async_redis.exists(stream_key):
+            result = await async_redis.get(f"response:{task_id}")
+            if result:
+                yield f"data: {json.dumps(result)}\n\n"
+                yield "event: done\ndata: {}\n\n"
+                return
+
+        entries = await async_redis.xread({stream_key: last_id}, count=100, block=STREAM_BLOCK_MS)
+        if not entries:
+            # Comment line keeps proxies from closing an idle connection
+            yield ": waiting\n\n"
+            continue
+
+        for _, messages in entries:
+            for entry_id, fields in messages:
+                last_id = entry_id
+                if "reset" in fields and sent_deltas:
+                    yield "event: reset\ndata: {}\n\n"
+                    sent_deltas = False
+                if "delta" in fields:
+                    yield f"data: {json.dumps(fields['delta'])}\n\n"
+                    sent_deltas = True
+                if "done" in fields:
+                    yield "event: done\ndata: {}\n\n"
+                    return
+
+    yield "event: timeout\ndata: {}\n\n"
+
+
+@app.get("/stream_result/{task_id}")
+async def stream_result(task_id: str, timeout: float = 600):
+    """Stream a task's result token by token as server-sent events."""
+    return StreamingResponse(
+        result_events(task_id, timeout),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@app.get("/cache_stats/")
+async def cache_stats():
+    """Hit/miss counters of the LLM result cache (API and workers) and of this replica's document cache."""
+    counters = {name: int(value) for name, value in (await async_redis.hgetall(RESULT_CACHE_STATS)).items()}
+    return {"entries": await async_redis.zcard(RESULT_CACHE_INDEX), **counters, "document_cache": document_cache.stats()}
@@ -1,75 +1,447 @@
 import io
+import os
+import re
+import shutil
+import time
+import threading
+import multiprocessing
 import fitz  # PyMuPDF
 import base64
+import hashlib
 from PIL import Image
 from io import BytesIO
+from collections import deque
+from tempfile import SpooledTemporaryFile
+from concurrent.futures import ProcessPoolExecutor
 from fastapi import FastAPI, File, UploadFile, HTTPException
 from fastapi.responses import JSONResponse
 app = FastAPI()
 
-def extract_data(pdf_file_io: BytesIO):
+# Number of processes used for page extraction (1 = extract in-process)
+EXTRACT_WORKERS = int(os.getenv("EXTRACT_WORKERS", os.cpu_count() or 1))
+# Start method of the extraction processes. The API process runs many threads, and
+# forking it can deadlock a child on a lock some other thread held at fork time
+EXTRACT_START_METHOD = os.getenv(
+    "EXTRACT_START_METHOD", "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+)
+# Pages handed to a pool worker at a time
+PAGES_PER_SHARD = int(os.getenv("PAGES_PER_SHARD", 8))
+# Tables and images are kept in memory up to this size before spilling to disk
+SPOOL_MAX_SIZE = int(os.getenv("SPOOL_MAX_SIZE", 8 * 1024 * 1024))
+# Characters buffered by MarkdownWriter before each write to its target
+MARKDOWN_BUFFER_SIZE = int(os.getenv("MARKDOWN_BUFFER_SIZE", 256 * 1024))
+# Image formats browsers display natively; these skip the PIL decode / PNG re-encode
+PASSTHROUGH_IMAGE_FORMATS = {"png", "jpeg", "gif", "webp"}
+# "lines" lists every text line as a row of spans, "detect" uses PyMuPDF's table finder
+TABLE_MODE = os.getenv("TABLE_MODE", "lines")
+
+PAGE_SECTION_PATTERN = re.compile(r"^### Page (\d+)\n", re.MULTILINE)
+
+
+class ImageCache:
+    """Per-document image cache keyed by xref.
+
+    Each xref is extracted once; pages that reuse it (logos, headers) get the
+    already-encoded bytes. Images in a web-friendly format are kept as
+    extracted, everything else is converted to PNG. The SHA-256 of the final
+    bytes is computed once here so images can be stored content-addressed.
+    `stats` records what the cache hits saved.
+    """
+
+    def __init__(self, doc, stats=None):
+        self.doc = doc
+        self._images = {}
+        self.stats = new_image_stats() if stats is None else stats
+
+    def get(self, xref):
+        """Return `(ext, image_bytes, sha256)` for the image, extracting it at most once."""
+        cached = self._images.get(xref)
+        if cached is not None:
+            ext, image_bytes, digest, cpu_seconds = cached
+            self.stats["cache_hits"] += 1
+            self.stats["bytes_saved"] += len(image_bytes)
+            self.stats["cpu_seconds_saved"] += cpu_seconds
+            return ext, image_bytes, digest
+
+        started = time.process_time()
+        base_image = self.doc.extract_image(xref)
+        ext = base_image["ext"]
+        image_bytes = base_image["image"]
+
+        if ext in PASSTHROUGH_IMAGE_FORMATS:
+            self.stats["passthrough"] += 1
+        else:
+            img = Image.open(BytesIO(image_bytes))
+            buffered = BytesIO()
+            img.save(buffered, format="PNG")
+            ext = "png"
+            image_bytes = buffered.getvalue()
+            self.stats["reencoded"] += 1
+
+        digest = hashlib.sha256(image_bytes).hexdigest()
+        cpu_seconds = time.process_time() - started
+        self._images[xref] = (ext, image_bytes, digest, cpu_seconds)
+        self.stats["unique_images"] += 1
+        return ext, image_bytes, digest
+
+
+def new_image_stats():
+    return {
+        "unique_images": 0,
+        "cache_hits": 0,
+        "passthrough": 0,
+        "reencoded": 0,
+        "bytes_saved": 0,
+        "cpu_seconds_saved": 0.0
+    }
+
+
+def _merge_image_stats(total, stats):
+    for key, value in stats.items():
+        total[key] += value
+
+
+def _text_line_rows(page):
+    """Group the page's text spans into one row per line.
+
+    The layout dict is only needed long enough to pull out the span text, so
+    it is dropped before the page record is built. Image blocks are left out
+    of it entirely (they carry the raw image bytes).
+    """
+    layout = page.get_text("dict", flags=fitz.TEXTFLAGS_DICT & ~fitz.TEXT_PRESERVE_IMAGES)
+    return tuple(
+        tuple(span["text"] for span in line["spans"])
+        for block in layout["blocks"] if block["type"] == 0
+        for line in block["lines"]
+    )
+
+
+def _detected_table_rows(page):
+    """Return the cell text of every table PyMuPDF's table finder detects on the page."""
+    return [
+        tuple(tuple(cell or "" for cell in row) for row in table.extract())
+        for table in page.find_tables().tables
+    ]
+
+
+def _extract_tables(page):
+    """Return the page's tables as compact tuples of rows, each row a tuple of cell strings."""
+    if TABLE_MODE == "detect" and hasattr(page, "find_tables"):
+        return _detected_table_rows(page)
+    return [_text_line_rows(page)]
+
+
+def _extract_page(doc, page_num, image_cache, foreign_xrefs=frozenset()):
+    """Extract the text, images and tables of a single page as a page record.
+
+    Images whose xref is in `foreign_xrefs` are extracted by another shard;
+    they are recorded as `{"xref", "name"}` references for `iter_pages` to resolve.
+    """
+    page = doc.load_page(page_num)
+
+    text = f"### Page {page_num + 1}\n\n"
+    text += page.get_text("text") + "\n\n"
+
+    images = []
+    image_list = page.get_images(full=True)
+    for img_index, img in enumerate(image_list):
+        name = f"image_{page_num + 1}_{img_index + 1}"
+        if img[0] in foreign_xrefs:
+            images.append({"xref": img[0], "name": name})
+            continue
+        ext, image_bytes, digest = image_cache.get(img[0])
+        images.append({
+            "filename": f"{name}.{ext}",
+            "ext": ext,
+            "data": image_bytes,
+            "sha256": digest,
+            "xref": img[0]
+        })
+
+    return {
+        "page": page_num + 1,
+        "text": text,
+        "tables": _extract_tables(page),
+        "images": images
+    }
+
+
+def open_pdf(pdf_source):
+    """Open a PDF given as a file path or as a BytesIO."""
+    if isinstance(pdf_source, (str, os.PathLike)):
+        return fitz.open(pdf_source, filetype="pdf")
+    return fitz.open(stream=pdf_source.getvalue(), filetype="pdf")
+
+
+def _extract_page_range(pdf_source, start, stop, foreign_xrefs=frozenset()):
+    """Process pool entry point: open the PDF and extract pages [start, stop).
+
+    `pdf_source` is a file path or the PDF bytes; images in `foreign_xrefs`
+    belong to an earlier shard and are only referenced. Returns the page
+    records together with the shard's image cache stats.
+    """
+    if isinstance(pdf_source, bytes):
+        doc = fitz.open(stream=pdf_source, filetype="pdf")
+    else:
+        doc = open_pdf(pdf_source)
+    try:
+        image_cache = ImageCache(doc)
+        pages = [_extract_page(doc, page_num, image_cache, foreign_xrefs) for page_num in range(start, stop)]
+        return pages, image_cache.stats
+    finally:
+        doc.close()
+
+
+def _shard_ranges(page_count):
+    """Split the page range into contiguous (start, stop) shards of PAGES_PER_SHARD pages."""
+    return [(start, min(start + PAGES_PER_SHARD, page_count)) for start in range(0, page_count, PAGES_PER_SHARD)]
+
+
+def _image_owners(doc, shards):
+    """Give each image xref to the first shard that uses it.
+
+    Only reads the pages' image lists, nothing is decoded. Returns, per shard,
+    the xrefs an earlier shard extracts, and the set of xrefs used by more
+    than one shard.
+    """
+    owners = {}
+    foreign = []
+    for shard_index, (start, stop) in enumerate(shards):
+        shard_foreign = set()
+        for page_num in range(start, stop):
+            for img in doc.get_page_images(page_num, full=True):
+                if owners.setdefault(img[0], shard_index) != shard_index:
+                    shard_foreign.add(img[0])
+        foreign.append(frozenset(shard_foreign))
+    return foreign, set().union(*foreign)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_extraction_pool():
+    """Return the process pool shared by every extraction, creating it on first use."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(
+                max_workers=EXTRACT_WORKERS, mp_context=multiprocessing.get_context(EXTRACT_START_METHOD)
+            )
+        return _pool
+
+
+def shutdown_extraction_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None
+
+
+def split_page_sections(markdown):
+    """Return `{page_num: text}` for the `### Page N` sections of a rendered markdown's text part."""
+    start = markdown.find("## Extracted Text\n")
+    end = markdown.find("## Extracted Tables\n", max(start, 0))
+    text = markdown[max(start, 0):end if end != -1 else len(markdown)]
+
+    matches = list(PAGE_SECTION_PATTERN.finditer(text))
+    pages = {}
+    for match, next_match in zip(matches, matches[1:] + [None]):
+        section_end = next_match.start() if next_match else len(text)
+        pages[int(match.group(1))] = text[match.end():section_end].strip()
+    return pages
+
+
+def count_pages(pdf_source):
+    """Return the number of pages in the PDF (a path or BytesIO) without extracting anything."""
+    with open_pdf(pdf_source) as doc:
+        return doc.page_count
+
+
+def iter_pages(pdf_source, workers=None, image_stats=None):
+    """Yield one record per page, in page order, as pages are extracted.
+
+    `pdf_source` is a file path or a BytesIO. Given a path, the PDF is never
+    read into memory here: PyMuPDF reads it from disk, and pool workers open
+    the file themselves instead of receiving its bytes.
+
+    Shards are extracted in the shared process pool, each worker opening the
+    PDF itself; the calling process only lists each page's image xrefs, so
+    that an image shared by several shards is extracted by the first one and
+    handed to the pages of the others. At most
+    `workers + 1` shards are in flight, so memory stays bounded by a few
+    shards rather than the whole document. With `workers=1` pages are
+    extracted serially in-process.
+
+    If `image_stats` is given (see `new_image_stats()`), image cache savings
+    are accumulated into it as shards complete.
+    """
+    workers = EXTRACT_WORKERS if workers is None else workers
+    image_stats = new_image_stats() if image_stats is None else image_stats
+    doc = open_pdf(pdf_source)
+    # Pool workers get the path when there is one, otherwise the bytes
+    shard_source = pdf_source if isinstance(pdf_source, (str, os.PathLike)) else pdf_source.getvalue()
+
+    try:
+        if workers <= 1:
+            image_cache = ImageCache(doc, image_stats)
+            for page_num in range(doc.page_count):
+                yield _extract_page(doc, page_num, image_cache)
+            return
+
+        shards = _shard_ranges(doc.page_count)
+        foreign_xrefs, shared_xrefs = _image_owners(doc, shards)
+        # Images of shared xrefs, kept from their owning shard for the shards after it
+        shared_images = {}
+
+        def drain(future):
+            pages, stats = future.result()
+            _merge_image_stats(image_stats, stats)
+            for page in pages:
+                for image in page["images"]:
+                    if "data" not in image:
+                        # Shards are drained in order, so the owner's copy is already here
+                        ext, image_bytes, digest = shared_images[image["xref"]]
+                        image.update(filename=f"{image.pop('name')}.{ext}", ext=ext, data=image_bytes, sha256=digest)
+                        image_stats["cache_hits"] += 1
+                        image_stats["bytes_saved"] += len(image_bytes)
+                    elif image["xref"] in shared_xrefs:
+                        shared_images[image["xref"]] = (image["ext"], image["data"], image["sha256"])
+            return pages
+
+        pool = get_extraction_pool()
+        pending = deque()
+        try:
+            for (start, stop), foreign in zip(shards, foreign_xrefs):
+                pending.append(pool.submit(_extract_page_range, shard_source, start, stop, foreign))
+                if len(pending) > workers:
+                    yield from drain(pending.popleft())
+            while pending:
+                yield from drain(pending.popleft())
+        finally:
+            for future in pending:
+                future.cancel()
+    finally:
+        doc.close()
+
+
+def extract_data(pdf_file_io: BytesIO, workers=None):
+    """Extract text, images and tables from every page of the PDF into one dict."""
     try:
-        doc = fitz.open(stream=pdf_file_io, filetype="pdf")
-        
-        text_data = ""
+        text_parts = []
         tables = []
         images = []
-        
-        for page_num in range(doc.page_count):
-            page = doc.load_page(page_num)
-            
-            text_data += f"### Page {page_num + 1}\n\n"
-            text_data += page.get_text("text") + "\n\n"
-            
-            image_list = page.get_images(full=True)
-            for img_index, img in enumerate(image_list):
-                xref = img[0]
-                base_image = doc.extract_image(xref)
-                image_bytes = base_image["image"]
-                img = Image.open(BytesIO(image_bytes))
-                img_filename = f"image_{page_num + 1}_{img_index + 1}.png"
-                
-                # Store image data directly instead of saving to file
-                buffered = BytesIO()
-                img.save(buffered, format="PNG")
-                img_base64 = base64.b64encode(buffered.getvalue()).decode("utf-8")
-                images.append({
-                    "filename": img_filename,
-                    "base64": img_base64
-                })
-            
-            table = page.get_text("dict")
-            tables.append(table)
-        
+        image_stats = new_image_stats()
+
+        for page in iter_pages(pdf_file_io, workers, image_stats):
+            text_parts.append(page["text"])
+            tables.extend(page["tables"])
+            images.extend(page["images"])
+
         return {
-            "text": text_data,
+            "text": "".join(text_parts),
             "tables": tables,
-            "images": images
+            "images": images,
+            "image_stats": image_stats
         }
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-def save_to_md(extracted_data):
+
+class MarkdownWriter:
+    """Buffered markdown writer over any file-like target.
+
+    Chunks are appended to a list and handed to `target.write` as one string
+    once `buffer_size` characters have accumulated, so rendering stays linear
+    in document size whether the target is a StringIO, a local file or an
+    S3 multipart part.
+    """
+
+    def __init__(self, target, buffer_size=None):
+        self.target = target
+        self.buffer_size = MARKDOWN_BUFFER_SIZE if buffer_size is None else buffer_size
+        self._chunks = []
+        self._size = 0
+
+    def write(self, text):
+        self._chunks.append(text)
+        self._size += len(text)
+        if self._size >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self._chunks:
+            self.target.write("".join(self._chunks))
+            self._chunks.clear()
+            self._size = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.flush()
+
+
+def _render_tables(tables, writer):
+    for table in tables:
+        writer.write("### Table\n")
+        for row in table:
+            writer.write(" | ".join(row))
+            writer.write("\n")
+        writer.write("\n")
+
+
+def _render_images(images, writer, image_store=None):
+    for img in images:
+        if image_store is not None:
+            writer.write(f"![{img['filename']}]({image_store(img)})\n")
+            continue
+        writer.write(f"![{img['filename']}](data:image/{img['ext']};base64,")
+        writer.write(base64.b64encode(img['data']).decode("ascii"))
+        writer.write(")\n")
+
+
+def save_to_md(extracted_data, sink=None, image_store=None):
+    """Render extracted data as markdown.
+
+    `extracted_data` is either the dict returned by `extract_data` or an
+    iterable of page records from `iter_pages`. Page text is written to `sink`
+    (any object with a `write(str)` method) as each page arrives; tables and
+    images are spooled to temporary files and appended afterwards, keeping the
+    section order of the document. Without a sink the markdown is returned as
+    a string.
+
+    Images are inlined as base64 data URIs unless `image_store` is given: it
+    is called with each image record and returns the URL the markdown should
+    reference instead.
+    """
+    if isinstance(extracted_data, dict):
+        extracted_data = [extracted_data]
+    out = io.StringIO() if sink is None else sink
+
     try:
-        markdown_content = "# Extracted Data from PDF\n\n"
-        
-        markdown_content += "## Extracted Text\n"
-        markdown_content += extracted_data["text"]
-        
-        markdown_content += "## Extracted Tables\n"
-        for table in extracted_data["tables"]:
-            markdown_content += "### Table\n"
-            for block in table["blocks"]:
-                if block['type'] == 0:
-                    for line in block["lines"]:
-                        line_text = " | ".join([span["text"] for span in line["spans"]])
-                        markdown_content += line_text + "\n"
-            markdown_content += "\n"
-        
-        markdown_content += "## Extracted Images\n"
-        for img in extracted_data["images"]:
-            markdown_content += f"![{img['filename']}](data:image/png;base64,{img['base64']})\n"
-        
-        return markdown_content
+        with SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE, mode="w+", encoding="utf-8") as tables_md, \
+                SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE, mode="w+", encoding="utf-8") as images_md:
+            with MarkdownWriter(out) as writer, \
+                    MarkdownWriter(tables_md) as tables_writer, \
+                    MarkdownWriter(images_md) as images_writer:
+                writer.write("# Extracted Data from PDF\n\n")
+                writer.write("## Extracted Text\n")
+                for page in extracted_data:
+                    writer.write(page["text"])
+                    _render_tables(page["tables"], tables_writer)
+                    _render_images(page["images"], images_writer, image_store)
+
+            out.write("## Extracted Tables\n")
+            tables_md.seek(0)
+            shutil.copyfileobj(tables_md, out, MARKDOWN_BUFFER_SIZE)
+
+            out.write("## Extracted Images\n")
+            images_md.seek(0)
+            shutil.copyfileobj(images_md, out, MARKDOWN_BUFFER_SIZE)
+
+        if sink is None:
+            return out.getvalue()
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=str(e))
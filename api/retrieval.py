@@ -0,0 +1,149 @@
+import io
+import os
+import re
+import hashlib
+import logging
+from functools import lru_cache
+import numpy as np
+from tokenization import token_windows
+
+logger = logging.getLogger(__name__)
+
+# Chunk size and overlap, in tokens of CHUNK_TOKENIZER_MODEL
+CHUNK_TOKENS = int(os.getenv("CHUNK_TOKENS", 350))
+CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", 50))
+CHUNK_TOKENIZER_MODEL = os.getenv("CHUNK_TOKENIZER_MODEL", "GPT-4o")
+# "hashing" is the offline hashing embedder. A sentence-transformers model name (e.g.
+# sentence-transformers/all-MiniLM-L6-v2) needs that package and the model in the image
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "hashing")
+HASHING_DIM = int(os.getenv("HASHING_DIM", 4096))
+
+PAGE_HEADER_PATTERN = re.compile(r"^### Page \d+\n+")
+TOKEN_PATTERN = re.compile(r"\w+")
+
+
+def chunk_page(page_num, text, size=CHUNK_TOKENS, overlap=CHUNK_OVERLAP_TOKENS):
+    """Split one page's text into overlapping `(page_num, chunk)` token windows."""
+    text = PAGE_HEADER_PATTERN.sub("", text).strip()
+    if not text:
+        return []
+    windows = token_windows(text, CHUNK_TOKENIZER_MODEL, size, overlap)
+    return [(page_num, window.strip()) for window in windows if window.strip()]
+
+
+class HashingEmbedder:
+    """Offline embedder: signed feature hashing of word unigrams and bigrams.
+
+    Needs no model download, so it also works where the sentence-transformers
+    model is unavailable. Vectors are L2-normalized.
+    """
+
+    name = "hashing"
+
+    def __init__(self, dim=HASHING_DIM):
+        self.dim = dim
+
+    def _features(self, text):
+        tokens = TOKEN_PATTERN.findall(text.lower())
+        return tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]
+
+    def embed(self, texts):
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            hashes = np.array(
+                [int.from_bytes(hashlib.blake2b(f.encode("utf-8"), digest_size=8).digest(), "little")
+                 for f in self._features(text)],
+                dtype=np.uint64
+            )
+            if not len(hashes):
+                continue
+            indices = (hashes % np.uint64(self.dim)).astype(np.int64)
+            signs = np.where(hashes >> np.uint64(63), 1.0, -1.0).astype(np.float32)
+            np.add.at(vectors[row], indices, signs)
+        return _normalize(vectors)
+
+
+class SentenceTransformerEmbedder:
+    """Local CPU embedding model loaded through sentence-transformers."""
+
+    def __init__(self, model_name):
+        from sentence_transformers import SentenceTransformer
+        self.name = model_name
+        self.model = SentenceTransformer(model_name, device="cpu")
+
+    def embed(self, texts):
+        vectors = self.model.encode(list(texts), batch_size=32, convert_to_numpy=True)
+        return _normalize(vectors.astype(np.float32))
+
+
+def _normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+@lru_cache(maxsize=4)
+def get_embedder(name=EMBEDDING_MODEL):
+    """Return the embedder called `name`, falling back to hashing if the model cannot be loaded."""
+    if name == HashingEmbedder.name:
+        return HashingEmbedder()
+    try:
+        return SentenceTransformerEmbedder(name)
+    except Exception as e:
+        logger.warning(f"⚠️ Embedding model {name} unavailable, using hashing embedder: {e}")
+        return HashingEmbedder()
+
+
+class VectorIndex:
+    """Chunk embeddings of one document, held as a normalized float32 matrix."""
+
+    def __init__(self, embedder_name, vectors, pages, chunks):
+        self.embedder_name = embedder_name
+        self.vectors = vectors
+        self.pages = pages
+        self.chunks = chunks
+
+    @classmethod
+    def build(cls, chunks, embedder=None):
+        """Embed `(page_num, text)` chunks into a new index."""
+        embedder = embedder or get_embedder()
+        texts = [text for _, text in chunks]
+        vectors = embedder.embed(texts) if texts else np.zeros((0, 1), dtype=np.float32)
+        pages = np.array([page_num for page_num, _ in chunks], dtype=np.int32)
+        return cls(embedder.name, vectors, pages, texts)
+
+    def search(self, query, k):
+        """Return the top-k `(score, page_num, text)` chunks by cosine similarity to `query`.
+
+        Raises ValueError if this process cannot embed the query the way the
+        index was embedded, e.g. the index's model is not installed here.
+        """
+        if not self.chunks:
+            return []
+        embedder = get_embedder(self.embedder_name)
+        if embedder.name != self.embedder_name:
+            raise ValueError(f"index was embedded with {self.embedder_name}, which is unavailable here")
+        query_vector = embedder.embed([query])[0]
+        if query_vector.shape[0] != self.vectors.shape[1]:
+            raise ValueError(f"query vectors have {query_vector.shape[0]} dimensions, the index {self.vectors.shape[1]}")
+        scores = self.vectors @ query_vector
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(float(scores[i]), int(self.pages[i]), self.chunks[i]) for i in top]
+
+    def to_bytes(self):
+        buffer = io.BytesIO()
+        np.savez_compressed(
+            buffer,
+            embedder=np.array(self.embedder_name),
+            vectors=self.vectors,
+            pages=self.pages,
+            chunks=np.array(self.chunks, dtype=str)
+        )
+        return buffer.getvalue()
+
+    @classmethod
+    def from_bytes(cls, data):
+        with np.load(io.BytesIO(data), allow_pickle=False) as arrays:
+            return cls(str(arrays["embedder"]), arrays["vectors"], arrays["pages"], arrays["chunks"].tolist())
@@ -1,35 +1,57 @@
 import streamlit as st
 import requests
 import time
-import tiktoken
+import json
+from tokenization import count_tokens
 import pandas as pd
 import matplotlib.pyplot as plt
 
 BASE_URL = "https://api-695260164759.us-central1.run.app"
 ##BASE_URL = "http://127.0.0.1:8000"
+# How long the Extraction tab follows an ingestion job before giving up on it
+INGEST_MAX_WAIT = 30 * 60
 
 # Sidebar Navigation
 st.sidebar.title("Navigation")
 selected_tab = st.sidebar.radio("Go to", ["Extraction", "LLM Processing"])
 
-def count_tokens(text, model):
-    """Counts tokens in a given text based on the selected model."""
-    try:
-        if model in ["GPT-4o", "GPT-3.5"]:
-            enc = tiktoken.encoding_for_model("gpt-4")
-            return len(enc.encode(text))
-        elif model in ["Claude", "Claude-3"]:
-            return int(len(text.split()) * 1.2)
-        elif model in ["Gemini-Flash", "Gemini-Pro"]:
-            return int(len(text.split()) * 1.15)
-        elif model in ["DeepSeek"]:
-            return int(len(text.split()) * 1.1)
-        elif model in ["Grok"]:
-            return int(len(text.split()) * 1.05)
-        else:
-            return len(text.split())
-    except Exception:
-        return len(text.split())
+@st.cache_data(ttl=300, show_spinner=False)
+def fetch_document_metadata(markdown):
+    """Page count, size and per-model token counts of a processed document; None if unavailable."""
+    response = requests.get(f"{BASE_URL}/document_metadata/{markdown}")
+    if response.status_code == 200:
+        return response.json()
+    return None
+
+def stream_result(task_id, timeout=600):
+    """Yield a task's result text as the API streams it (server-sent events).
+
+    Yields None when the task was restarted and the text so far must be discarded.
+    """
+    with requests.get(
+        f"{BASE_URL}/stream_result/{task_id}", params={"timeout": timeout}, stream=True, timeout=(10, 60)
+    ) as response:
+        event = "message"
+        for line in response.iter_lines(decode_unicode=True):
+            if line.startswith("event:"):
+                event = line[len("event:"):].strip()
+            elif line.startswith("data:"):
+                if event == "reset":
+                    yield None
+                elif event != "message":
+                    return
+                else:
+                    yield json.loads(line[len("data:"):].strip())
+            elif not line:
+                event = "message"
+
+def render_stream(task_id, placeholder, timeout=600):
+    """Show a task's result in `placeholder` as it streams in; returns the full text."""
+    text = ""
+    for delta in stream_result(task_id, timeout):
+        text = "" if delta is None else text + delta
+        placeholder.markdown(text)
+    return text
 
 MODEL_PRICING = {
     "GPT-4o": {"input_price": 5.00, "output_price": 10.00}, 
@@ -48,13 +70,36 @@ if selected_tab == "Extraction":
 
     if uploaded_file:
      if st.button("Extract Text ", use_container_width=True):
-        with st.spinner(" Extracting text from PDF..."):
-            files = {"file": (uploaded_file.name, uploaded_file.getvalue(), "application/pdf")}
-            response = requests.post(f"{BASE_URL}/upload_pdf/", files=files)
+        files = {"file": (uploaded_file.name, uploaded_file.getvalue(), "application/pdf")}
+        response = requests.post(f"{BASE_URL}/upload_pdf/", files=files)
 
-            if response.status_code == 200:
-                scraped_file = response.json()["filename"]
-                s3_url = response.json()["s3_url"]  # ✅ Get S3 URL
+        if response.status_code == 200:
+            job_id = response.json()["job_id"]
+            scraped_file = response.json()["filename"]
+            s3_url = response.json()["s3_url"]  # ✅ Get S3 URL
+
+            # ✅ Follow the ingestion job instead of blocking on the upload
+            progress_bar = st.progress(0.0, text="Extracting text from PDF...")
+            job = {"status": "queued"}
+            deadline = time.monotonic() + INGEST_MAX_WAIT
+            while job["status"] in ("queued", "processing"):
+                if time.monotonic() > deadline:
+                    job = {"status": "timeout"}
+                    break
+                time.sleep(1)
+                status_response = requests.get(f"{BASE_URL}/ingest_status/{job_id}")
+                if status_response.status_code != 200:
+                    job = {"status": "failed", "error": status_response.text}
+                    break
+                job = status_response.json()
+                if job["page_count"]:
+                    progress_bar.progress(
+                        job["pages_done"] / job["page_count"],
+                        text=f"Extracted page {job['pages_done']} of {job['page_count']}"
+                    )
+
+            if job["status"] == "done":
+                progress_bar.progress(1.0, text="Extraction complete")
                 st.success(f" PDF extracted! Saved as `{scraped_file}` in S3.")
 
                 # 🔍 Debug: Display S3 URL
@@ -68,9 +113,16 @@ if selected_tab == "Extraction":
                     st.session_state["extracted_text"] = extracted_text
                 else:
                     st.error(f"❌ Failed to retrieve extracted text. Error Code: {text_response.status_code}")
-
+            elif job["status"] == "timeout":
+                st.warning(
+                    f"⚠️ Extraction is still running after {INGEST_MAX_WAIT // 60} minutes (job `{job_id}`). "
+                    "The file will appear under LLM Processing once it finishes."
+                )
             else:
-                st.error(f"❌ Upload failed: {response.text}")
+                st.error(f"❌ Extraction failed: {job.get('error', 'unknown error')}")
+
+        else:
+            st.error(f"❌ Upload failed: {response.text}")
 
 # ✅ Show Extracted Text
     if "extracted_text" in st.session_state:
@@ -87,13 +139,16 @@ elif selected_tab == "LLM Processing":
     # 3️⃣ **List Available Processed Files**
     st.markdown("<h2 style='text-align: center; color: Black;'>Select Processed File</h2>", unsafe_allow_html=True)
 
-    response = requests.get(f"{BASE_URL}/select_pdfcontent/")
+    name_prefix = st.text_input("Filter files by name prefix", key="name_prefix")
+    response = requests.get(f"{BASE_URL}/select_pdfcontent/", params={"prefix": name_prefix, "limit": 200})
 
     if response.status_code == 200:
         markdown_files = response.json().get("markdowns", [])
     
         if markdown_files:
             selected_markdown = st.selectbox("Select a Processed Markdown File ", markdown_files)
+            if response.json().get("next_cursor"):
+                st.caption("Showing the first 200 files; type a longer prefix to narrow the list.")
         else:
             st.warning("⚠️ No processed Markdown files found. Upload a PDF first.")
             selected_markdown = None
@@ -107,6 +162,7 @@ elif selected_tab == "LLM Processing":
         st.session_state["summary"] = None
 
 # Summarization Section
+    summary_streamed = False
     st.markdown("<h2 style='text-align: center; color: black;'>Summarization</h2>", unsafe_allow_html=True)
 
     if selected_markdown and st.button("Summarize Document ", use_container_width=True):
@@ -118,23 +174,19 @@ elif selected_tab == "LLM Processing":
 
         if response.status_code == 200:
             task_id = response.json().get("task_id")
-            elapsed_time = 0
-            max_wait_time = 600  # 10 minutes timeout
-
-            while elapsed_time < max_wait_time:
-                time.sleep(2)  # Reduce API load
-                elapsed_time += 2
-                result_response = requests.get(f"{BASE_URL}/get_result/{task_id}")
-
-                try:
-                    result_data = result_response.json()
-                    if "result" in result_data:
-                        # ✅ Store summary in session state
-                        st.session_state["summary"] = result_data["result"]
-                        break
-                except requests.exceptions.JSONDecodeError:
-                    st.error(" Failed to retrieve a valid response from the server.")
-                    break
+
+            # ✅ Render the summary token by token as the worker streams it
+            st.markdown("<h3 style='text-align: center; color: black;'>Summarization Result:</h3>", unsafe_allow_html=True)
+            try:
+                summary = render_stream(task_id, st.empty(), timeout=600)
+            except requests.exceptions.RequestException as e:
+                summary = None
+                st.error(f" Failed to stream the summary: {e}")
+
+            if summary:
+                # ✅ Store summary in session state
+                st.session_state["summary"] = summary
+                summary_streamed = True
             else:
                 st.error(" Summarization took too long. Please try again later.")
         else:
@@ -142,7 +194,7 @@ elif selected_tab == "LLM Processing":
     
     
 # ✅ Display stored summary even after refresh
-    if st.session_state["summary"]:
+    if st.session_state["summary"] and not summary_streamed:
         st.markdown("<h3 style='text-align: center; color: black;'>Summarization Result:</h3>", unsafe_allow_html=True)
         st.write(st.session_state["summary"])
 # ✅ Ensure session state has "answer" key
@@ -167,15 +219,18 @@ elif selected_tab == "LLM Processing":
         if response.status_code == 200:
             task_id = response.json().get("task_id")
 
-            while True:
-                time.sleep(2)
-                result_response = requests.get(f"{BASE_URL}/get_result/{task_id}")
-                result_data = result_response.json()
+            # ✅ Render the answer token by token as the worker streams it
+            try:
+                answer = render_stream(task_id, answer_placeholder, timeout=600)
+            except requests.exceptions.RequestException as e:
+                answer = None
+                st.error(f" Failed to stream the answer: {e}")
 
-                if "result" in result_data:
-                    # ✅ Store answer in session state
-                    st.session_state["answer"] = result_data["result"]
-                    break
+            if answer:
+                # ✅ Store answer in session state
+                st.session_state["answer"] = answer
+            else:
+                st.error(" Answering took too long. Please try again later.")
         else:
             st.error(f" Failed to submit question request: {response.text}")
      
@@ -185,16 +240,14 @@ elif selected_tab == "LLM Processing":
         answer_placeholder.write(st.session_state["answer"])
 
     if selected_markdown:
-    # Fetch the file content
-        file_response = requests.get(f"{BASE_URL}/download_markdown/{selected_markdown}")
+    # Token counts are computed by the API at ingest; only the metadata is fetched
+        metadata = fetch_document_metadata(selected_markdown)
 
-        if file_response.status_code == 200:
-            file_content = file_response.text
-            pdf_token_count = count_tokens(file_content, model)  # ✅ Dynamic token count
-            st.session_state["pdf_token_count"] = pdf_token_count
+        if metadata:
+            st.session_state["pdf_token_count"] = metadata["tokens"].get(model, 0)  # ✅ Dynamic token count
         else:
             st.session_state["pdf_token_count"] = 0
-            st.error(" Failed to fetch file content.")
+            st.error(" Failed to fetch document metadata.")
 
 # ✅ Display token count for the selected PDF
     if "pdf_token_count" in st.session_state:
@@ -219,17 +272,6 @@ elif selected_tab == "LLM Processing":
         st.markdown(f" **Token Count for Answer**: {st.session_state['answer_token_count']} tokens")
 
     if selected_markdown and model:
-    # Fetch the file content only when both file and model are selected
-        file_response = requests.get(f"{BASE_URL}/download_markdown/{selected_markdown}")
-
-        if file_response.status_code == 200:
-            file_content = file_response.text
-            pdf_token_count = count_tokens(file_content, model)  # ✅ Dynamic token count
-            st.session_state["pdf_token_count"] = pdf_token_count
-        else:
-            st.session_state["pdf_token_count"] = 0
-            st.error(" Failed to fetch file content.")
-
         # ✅ Display token count and cost for the selected PDF
         pdf_price = (st.session_state["pdf_token_count"] / 1_000_000) * MODEL_PRICING[model]["input_price"]
         st.markdown(f" **Cost for pdf:** ${pdf_price:.5f}")
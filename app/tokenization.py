@@ -0,0 +1,143 @@
+import re
+from functools import lru_cache
+
+try:
+    import tiktoken
+except ImportError:  # Without tiktoken every model uses the word-count estimate
+    tiktoken = None
+
+# This module is shared by the API, the worker and the UI; keep the copies in
+# api/, Worker/ and app/ identical so token counts agree everywhere
+# (tests/test_tokenization_copies.py fails when they diverge).
+
+# Models with a local tokenizer, mapped to the tiktoken model name
+TIKTOKEN_MODELS = {"GPT-4o": "gpt-4o", "GPT-3.5": "gpt-3.5-turbo"}
+# Tokens per whitespace-separated word for models without a local tokenizer
+WORD_TOKEN_RATIOS = {
+    "Claude": 1.2,
+    "Claude-3": 1.2,
+    "Gemini-Flash": 1.15,
+    "Gemini-Pro": 1.15,
+    "DeepSeek": 1.1,
+    "Grok": 1.05
+}
+
+PAGE_BREAK_PATTERN = re.compile(r"(?=^### Page \d+$)", re.MULTILINE)
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model):
+    """Return the tiktoken encoding for a model, loaded once per process; None if it has none."""
+    if tiktoken is None or model not in TIKTOKEN_MODELS:
+        return None
+    try:
+        return tiktoken.encoding_for_model(TIKTOKEN_MODELS[model])
+    except Exception:
+        return None
+
+
+def count_tokens(text, model):
+    """Counts tokens in a given text based on the selected model."""
+    encoding = get_encoding(model)
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    return int(len(text.split()) * WORD_TOKEN_RATIOS.get(model, 1.0))
+
+
+def count_tokens_batch(texts, model):
+    """Token counts for several texts, encoded in one batch where a tokenizer is available."""
+    encoding = get_encoding(model)
+    if encoding is not None:
+        return [len(tokens) for tokens in encoding.encode_batch(list(texts), disallowed_special=())]
+    return [count_tokens(text, model) for text in texts]
+
+
+class TokenCounter:
+    """Token count of a text fed in pieces, equal to `count_tokens` of the whole when pieces end at line breaks."""
+
+    def __init__(self, model):
+        self.model = model
+        self.tokens = 0
+        self.words = 0
+
+    def add(self, text):
+        if get_encoding(self.model) is not None:
+            self.tokens += count_tokens(text, self.model)
+        else:
+            self.words += len(text.split())
+
+    def total(self):
+        return self.tokens + int(self.words * WORD_TOKEN_RATIOS.get(self.model, 1.0))
+
+
+def token_windows(text, model, size, overlap=0):
+    """Cut text into windows of `size` tokens, consecutive windows sharing `overlap` tokens.
+
+    A last window that would add fewer than `overlap` new tokens is merged
+    into the one before it, which then runs to the end (under `size + overlap`
+    tokens), so no window is a near-copy of its neighbour.
+    """
+    step = max(size - overlap, 1)
+    encoding = get_encoding(model)
+    if encoding is not None:
+        tokens = encoding.encode(text, disallowed_special=())
+        return [encoding.decode(tokens[start:stop]) for start, stop in _window_bounds(len(tokens), size, step)]
+
+    # Without a tokenizer, cut on words using the model's words-to-tokens ratio
+    ratio = WORD_TOKEN_RATIOS.get(model, 1.0)
+    words = text.split()
+    word_size = max(int(size / ratio), 1)
+    word_step = max(int(step / ratio), 1)
+    return [" ".join(words[start:stop]) for start, stop in _window_bounds(len(words), word_size, word_step)]
+
+
+def _window_bounds(length, size, step):
+    """`(start, stop)` of each window over `length` items; the last one runs to the end."""
+    overlap = size - step
+    starts = list(range(0, max(length - overlap, 1), step))
+    if len(starts) > 1 and length - starts[-1] - overlap < overlap:
+        starts.pop()
+    return [(start, start + size) for start in starts[:-1]] + [(starts[-1], length)]
+
+
+def chunk_markdown(text, model, budget):
+    """Split markdown into chunks of at most `budget` tokens.
+
+    Splits happen at `### Page N` headings first, then at paragraphs; a
+    paragraph that is still too long is cut into token windows. Consecutive
+    pieces are then packed back together up to the budget.
+    """
+    pieces = []
+    for section in PAGE_BREAK_PATTERN.split(text):
+        if not section.strip():
+            continue
+        if count_tokens(section, model) <= budget:
+            pieces.append(section)
+            continue
+        for paragraph in section.split("\n\n"):
+            if count_tokens(paragraph, model) <= budget:
+                pieces.append(paragraph)
+            else:
+                pieces.extend(token_windows(paragraph, model, budget))
+    return ["\n\n".join(group) for group in pack_by_tokens(pieces, model, budget)]
+
+
+def pack_by_tokens(pieces, model, budget, min_per_group=1):
+    """Greedily group consecutive pieces so each group stays within `budget` tokens.
+
+    A group closes only once it has `min_per_group` pieces, which lets callers
+    force progress when merging already-large pieces.
+    """
+    groups = []
+    current = []
+    current_tokens = 0
+    for piece, piece_tokens in zip(pieces, count_tokens_batch(pieces, model)):
+        if current and current_tokens + piece_tokens > budget and len(current) >= min_per_group:
+            groups.append(current)
+            current = []
+            current_tokens = 0
+        current.append(piece)
+        current_tokens += piece_tokens
+    if current:
+        groups.append(current)
+    return groups
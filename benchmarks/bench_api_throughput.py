@@ -0,0 +1,68 @@
+"""Throughput of concurrent /get_result/ and /get_extracted_text/ requests.
+
+Clients request a stored result and a stored extracted text in a loop for a
+fixed time. Every Redis command takes `--redis-latency-ms`, a network round
+trip to a Redis server; when handlers make blocking Redis calls on the event
+loop, requests queue behind each other's round trips instead of overlapping.
+
+    python benchmarks/bench_api_throughput.py --clients 32 --seconds 10
+    python benchmarks/bench_api_throughput.py --api-dir /tmp/before/api
+"""
+import os
+import sys
+import time
+import json
+import logging
+import argparse
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import httpx  # noqa: E402
+from common import API_DIR, latency_summary, start_api  # noqa: E402
+
+ENDPOINTS = {"get_result": "/get_result/bench-task", "get_extracted_text": "/get_extracted_text/bench.md"}
+
+
+def request_loop(base_url, path, stop, samples):
+    with httpx.Client(base_url=base_url, timeout=120) as client:
+        while not stop.is_set():
+            started = time.perf_counter()
+            response = client.get(path)
+            assert response.status_code == 200, response.text
+            samples.append(time.perf_counter() - started)
+
+
+def run_phase(base_url, path, clients, seconds):
+    stop = threading.Event()
+    samples = []
+    threads = [threading.Thread(target=request_loop, args=(base_url, path, stop, samples)) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    return {"requests_per_second": round(len(samples) / seconds, 1), **latency_summary(samples)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--api-dir", default=API_DIR)
+    parser.add_argument("--clients", type=int, default=32)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--redis-latency-ms", type=float, default=1.0)
+    args = parser.parse_args()
+
+    base_url, main_module, server = start_api(args.api_dir, redis_latency=args.redis_latency_ms / 1000)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    main_module.redis_client.set("response:bench-task", "Summary " * 200)
+    main_module.redis_client.set("extracted_text:bench.md", "Extracted text " * 2000)
+
+    for name, path in ENDPOINTS.items():
+        print(json.dumps({"endpoint": name, **run_phase(base_url, path, args.clients, args.seconds)}))
+    server.should_exit = True
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""Markdown render time and peak memory against page count.
+
+Builds synthetic PDFs (a text block and one distinct image per page),
+extracts their page records once, then renders them three ways:
+
+- concat: the original `markdown_content += ...` renderer, for comparison
+- writer: `save_to_md` returning a string (StringIO target)
+- file:   `save_to_md` streaming into a file on disk
+
+Peak memory is the tracemalloc peak during rendering, so it counts Python
+allocations only. Run from the repository root:
+
+    python benchmarks/bench_render.py 50 200 800
+"""
+import io
+import os
+import sys
+import time
+import base64
+import tempfile
+import argparse
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "api"))
+
+import fitz  # noqa: E402
+from openSourcePdf import iter_pages, save_to_md  # noqa: E402
+
+LINE = "Revenue increased 12% year over year, driven by subscription growth in all regions."
+
+
+def make_pdf(path, page_count):
+    doc = fitz.open()
+    for page_num in range(page_count):
+        page = doc.new_page()
+        page.insert_text((72, 72), "\n".join(f"{page_num}:{line} {LINE}" for line in range(40)), fontsize=8)
+        # A distinct image per page, so image deduplication does not shrink the output
+        pixmap = fitz.Pixmap(fitz.csRGB, fitz.IRect(0, 0, 64, 64), False)
+        pixmap.set_rect(pixmap.irect, (page_num % 256, 80, 160))
+        page.insert_image(fitz.Rect(72, 500, 200, 628), pixmap=pixmap)
+    doc.save(path)
+
+
+def render_concat(pages):
+    """The pre-writer renderer: one growing string, inline base64 images."""
+    markdown_content = "# Extracted Data from PDF\n\n"
+    markdown_content += "## Extracted Text\n"
+    for page in pages:
+        markdown_content += page["text"]
+    markdown_content += "## Extracted Tables\n"
+    for page in pages:
+        for table in page["tables"]:
+            markdown_content += "### Table\n"
+            for row in table:
+                markdown_content += " | ".join(row) + "\n"
+            markdown_content += "\n"
+    markdown_content += "## Extracted Images\n"
+    for page in pages:
+        for img in page["images"]:
+            markdown_content += f"![{img['filename']}](data:image/{img['ext']};base64,{base64.b64encode(img['data']).decode()})\n"
+    return markdown_content
+
+
+def render_writer(pages):
+    return save_to_md(iter(pages))
+
+
+def render_file(pages):
+    with tempfile.TemporaryFile("w", encoding="utf-8") as md_file:
+        save_to_md(iter(pages), sink=md_file)
+        return md_file.tell()
+
+
+def measure(render, pages):
+    tracemalloc.start()
+    started = time.perf_counter()
+    render(pages)
+    elapsed = time.perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("page_counts", nargs="*", type=int, default=[50, 200, 800])
+    args = parser.parse_args()
+
+    print(f"{'pages':>6} {'markdown MB':>12} {'renderer':>9} {'seconds':>8} {'peak MB':>8}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for page_count in args.page_counts:
+            pdf_path = os.path.join(tmp, f"bench-{page_count}.pdf")
+            make_pdf(pdf_path, page_count)
+            pages = list(iter_pages(pdf_path, workers=1))
+            size = len(render_writer(pages).encode("utf-8")) / 1024 ** 2
+            for name, render in (("concat", render_concat), ("writer", render_writer), ("file", render_file)):
+                elapsed, peak = measure(render, pages)
+                print(f"{page_count:>6} {size:>12.1f} {name:>9} {elapsed:>8.3f} {peak / 1024 ** 2:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""Request volume and notification latency of result delivery with many waiting clients.
+
+Each client waits for its own task, which a simulated worker finishes at a
+random time: it writes the response stream, stores the result and publishes
+it on RESULT_CHANNEL, as Worker/worker.py does. Clients wait the old way
+(/get_result/ every 2 s), by long-polling /wait_result/, or by following
+/stream_result/. Latency runs from the worker storing the result to the
+client receiving it.
+
+    python benchmarks/bench_result_delivery.py --clients 100 --spread 10
+"""
+import os
+import sys
+import time
+import json
+import random
+import logging
+import argparse
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import httpx  # noqa: E402
+from common import API_DIR, latency_summary, start_api  # noqa: E402
+
+
+def poll(client, task_id, interval):
+    requests = 0
+    while True:
+        requests += 1
+        if client.get(f"/get_result/{task_id}").status_code == 200:
+            return requests
+        time.sleep(interval)
+
+
+def long_poll(client, task_id):
+    requests = 0
+    while True:
+        requests += 1
+        if client.get(f"/wait_result/{task_id}", params={"timeout": 30}).status_code == 200:
+            return requests
+
+
+def stream(client, task_id):
+    with client.stream("GET", f"/stream_result/{task_id}", params={"timeout": 600}) as response:
+        for line in response.iter_lines():
+            if line.startswith("event: done"):
+                return 1
+
+
+def finish_tasks(main_module, finish_at, finished):
+    """Complete each task at its scheduled time, the way a worker stores a result."""
+    redis_client = main_module.redis_client
+    for at, task_id in sorted((at, task_id) for task_id, at in finish_at.items()):
+        time.sleep(max(0, at - time.monotonic()))
+        redis_client.xadd(f"response_stream:{task_id}", {"delta": "Answer"})
+        redis_client.xadd(f"response_stream:{task_id}", {"done": "1"})
+        redis_client.set(f"response:{task_id}", "Answer")
+        finished[task_id] = time.monotonic()
+        redis_client.publish(main_module.RESULT_CHANNEL, task_id)
+
+
+def run_mode(base_url, main_module, mode, clients, spread, interval, seed, warmup=3):
+    rng = random.Random(seed)
+    # No task finishes until every client has had time to connect and start waiting
+    started = time.monotonic() + warmup
+    finish_at = {f"{mode}-{i}": started + rng.uniform(0, spread) for i in range(clients)}
+    finished, received, requests = {}, {}, []
+
+    def wait(task_id):
+        with httpx.Client(base_url=base_url, timeout=120) as client:
+            if mode == "poll":
+                count = poll(client, task_id, interval)
+            elif mode == "wait":
+                count = long_poll(client, task_id)
+            else:
+                count = stream(client, task_id)
+        received[task_id] = time.monotonic()
+        requests.append(count)
+
+    threads = [threading.Thread(target=wait, args=(task_id,)) for task_id in finish_at]
+    for thread in threads:
+        thread.start()
+    finish_tasks(main_module, finish_at, finished)
+    for thread in threads:
+        thread.join()
+
+    summary = latency_summary([received[task_id] - finished[task_id] for task_id in finish_at])
+    return {"mode": mode, "requests": sum(requests), **{k: v for k, v in summary.items() if k != "requests"}}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--api-dir", default=API_DIR)
+    parser.add_argument("--clients", type=int, default=100)
+    parser.add_argument("--spread", type=float, default=10, help="tasks finish uniformly within this many seconds")
+    parser.add_argument("--interval", type=float, default=2, help="seconds between /get_result/ polls")
+    parser.add_argument("--modes", default="poll,wait,stream")
+    args = parser.parse_args()
+
+    base_url, main_module, server = start_api(args.api_dir)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    for seed, mode in enumerate(args.modes.split(",")):
+        print(json.dumps(run_mode(base_url, main_module, mode, args.clients, args.spread, args.interval, seed)))
+    server.should_exit = True
+
+
+if __name__ == "__main__":
+    main()
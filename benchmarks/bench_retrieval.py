@@ -0,0 +1,110 @@
+"""Prompt tokens and latency of retrieval-based Q&A against full-document prompts.
+
+Builds a synthetic report with one known fact per page, then asks a question
+about each of a sample of facts. For every Q&A mode it reports the prompt
+size the worker would send, the time the API spends retrieving context
+(index load excluded), and how often the page holding the answer made it
+into the prompt. Pass a processed markdown file to measure prompt sizes on a
+real document instead (recall is then not reported).
+
+    python benchmarks/bench_retrieval.py --pages 300
+    python benchmarks/bench_retrieval.py --markdown markdowns/report.md --question "What was revenue?"
+"""
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from common import API_DIR  # noqa: E402
+
+sys.path.insert(0, API_DIR)
+from bm25 import BM25Index  # noqa: E402
+from openSourcePdf import split_page_sections  # noqa: E402
+from retrieval import HashingEmbedder, VectorIndex, chunk_page  # noqa: E402
+from tokenization import count_tokens  # noqa: E402
+
+METRICS = ["revenue", "headcount", "churn", "backlog", "capex", "inventory"]
+REGIONS = ["Lyon", "Osaka", "Denver", "Lagos", "Lima", "Perth", "Oslo", "Pune"]
+FILLER = (
+    "operations remained stable during the period while management continued to review "
+    "supplier contracts logistics costs and the hiring plan across business units"
+).split()
+
+
+def make_document(page_count, seed=7):
+    """Markdown in the ingest layout, plus the `(question, page)` pairs it answers."""
+    rng = random.Random(seed)
+    pages, facts = [], []
+    for page_num in range(1, page_count + 1):
+        metric, region, year = rng.choice(METRICS), rng.choice(REGIONS), 2000 + page_num
+        words = [rng.choice(FILLER) for _ in range(350)]
+        words.insert(rng.randrange(len(words)), f"The {metric} for {region} in {year} was {rng.randint(10, 999)} million.")
+        pages.append(f"### Page {page_num}\n\n{' '.join(words)}\n\n")
+        facts.append((f"What was the {metric} for {region} in {year}?", page_num))
+    return "# Extracted Data from PDF\n\n## Extracted Text\n" + "".join(pages), facts
+
+
+def excerpt_prompt(question, context):
+    excerpts = "\n\n".join(f"[Page {chunk['page']}]\n{chunk['text']}" for chunk in context)
+    return (
+        f"Answer this question: {question} based on the following excerpts from the document. "
+        f"Cite the page numbers you used, e.g. (p. 3).\n\n{excerpts}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--pages", type=int, default=300)
+    parser.add_argument("--questions", type=int, default=50)
+    parser.add_argument("--markdown", help="a processed markdown file to use instead of the synthetic report")
+    parser.add_argument("--question", action="append", help="question to ask (with --markdown)")
+    parser.add_argument("--model", default="GPT-4o", help="model whose tokenizer counts prompt tokens")
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--top-pages", type=int, default=3)
+    args = parser.parse_args()
+
+    if args.markdown:
+        with open(args.markdown, encoding="utf-8") as md_file:
+            document = md_file.read()
+        questions = [(question, None) for question in (args.question or ["What are the main findings?"])]
+    else:
+        document, facts = make_document(args.pages)
+        questions = random.Random(1).sample(facts, min(args.questions, len(facts)))
+
+    pages = split_page_sections(document)
+    started = time.perf_counter()
+    chunks = [chunk for page_num, text in pages.items() for chunk in chunk_page(page_num, text)]
+    vector_index = VectorIndex.build(chunks, HashingEmbedder())
+    bm25_index = BM25Index()
+    for page_num, text in pages.items():
+        bm25_index.add_page(page_num, text)
+    print(f"{len(pages)} pages, {len(chunks)} chunks, indexed in {time.perf_counter() - started:.2f}s")
+
+    def full(question):
+        return f"Answer this question: {question} based on the following document:\n\n{document}", None
+
+    def vector(question):
+        context = [{"page": page, "text": text} for _, page, text in vector_index.search(question, args.top_k)]
+        return excerpt_prompt(question, context), {chunk["page"] for chunk in context}
+
+    def bm25(question):
+        context = [{"page": page, "text": pages[page]} for page, _ in bm25_index.search(question, args.top_pages)]
+        return excerpt_prompt(question, context), {chunk["page"] for chunk in context}
+
+    print(f"{'mode':>7} {'prompt tokens':>14} {'retrieval ms':>13} {'answer page sent':>17}")
+    for name, build_prompt in (("full", full), ("vector", vector), ("bm25", bm25)):
+        tokens, latencies, hits = [], [], 0
+        for question, answer_page in questions:
+            started = time.perf_counter()
+            prompt, sent_pages = build_prompt(question)
+            latencies.append(time.perf_counter() - started)
+            tokens.append(count_tokens(prompt, args.model))
+            hits += sent_pages is None or answer_page in sent_pages
+        recall = "" if args.markdown else f"{hits / len(questions):.0%}"
+        print(f"{name:>7} {sum(tokens) / len(tokens):>14,.0f} {sum(latencies) / len(latencies) * 1000:>13.2f} {recall:>17}")
+
+
+if __name__ == "__main__":
+    main()
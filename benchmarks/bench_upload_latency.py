@@ -0,0 +1,93 @@
+"""Latency of /get_result/ polls while PDF uploads run at the same time.
+
+Pollers fetch a stored result in a loop, first on an idle API, then while
+uploaders keep posting a PDF to /upload_pdf/. If extraction or S3/Redis
+calls run on the event loop, the polls queue behind them and p99 jumps.
+
+    python benchmarks/bench_upload_latency.py --pages 200 --seconds 20
+"""
+import io
+import os
+import sys
+import time
+import argparse
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fitz  # noqa: E402
+import httpx  # noqa: E402
+from PIL import Image  # noqa: E402
+from common import API_DIR, latency_summary, start_api  # noqa: E402
+
+
+def make_pdf(path, page_count, seed):
+    doc = fitz.open()
+    for page_num in range(page_count):
+        page = doc.new_page()
+        page.insert_text((72, 72), "\n".join(f"Line {line} of page {page_num}, with some filler text." for line in range(40)))
+        # Images differ per page and per PDF: moto fails concurrent writes to one key, which
+        # content-addressed images shared by simultaneous uploads would cause
+        image = io.BytesIO()
+        Image.new("RGB", (128, 128), (page_num % 256, seed % 256, seed // 256 % 256)).save(image, "PNG")
+        page.insert_image(fitz.Rect(72, 500, 200, 628), stream=image.getvalue())
+    doc.save(path)
+
+
+def poll(base_url, stop, samples):
+    with httpx.Client(base_url=base_url, timeout=120) as client:
+        while not stop.is_set():
+            started = time.perf_counter()
+            client.get("/get_result/bench-task")
+            samples.append(time.perf_counter() - started)
+
+
+def upload(base_url, pdf_paths, stop, counter):
+    with httpx.Client(base_url=base_url, timeout=600) as client:
+        while not stop.is_set() and pdf_paths:
+            pdf_path = pdf_paths.pop()
+            with open(pdf_path, "rb") as pdf_file:
+                client.post("/upload_pdf/", files={"file": (os.path.basename(pdf_path), pdf_file, "application/pdf")})
+            counter.append(1)
+
+
+def run_phase(base_url, pdf_paths, pollers, uploaders, seconds):
+    stop = threading.Event()
+    samples, uploads = [], []
+    threads = [threading.Thread(target=poll, args=(base_url, stop, samples)) for _ in range(pollers)]
+    threads += [threading.Thread(target=upload, args=(base_url, pdf_paths, stop, uploads)) for _ in range(uploaders)]
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    return {**latency_summary(samples), "uploads": len(uploads)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--api-dir", default=API_DIR)
+    parser.add_argument("--pages", type=int, default=200)
+    parser.add_argument("--pollers", type=int, default=4)
+    parser.add_argument("--uploaders", type=int, default=2)
+    parser.add_argument("--seconds", type=float, default=20)
+    parser.add_argument("--pdfs", type=int, default=40, help="distinct PDFs to upload, at most one upload each")
+    args = parser.parse_args()
+
+    pdf_dir = tempfile.mkdtemp(prefix="bench-pdf-")
+    pdf_paths = []
+    for seed in range(args.pdfs):
+        pdf_paths.append(os.path.join(pdf_dir, f"bench-{seed}.pdf"))
+        make_pdf(pdf_paths[-1], args.pages, seed)
+    base_url, main_module, server = start_api(args.api_dir)
+    main_module.redis_client.set("response:bench-task", "done")
+
+    print("idle:        ", run_phase(base_url, [], args.pollers, 0, args.seconds / 2))
+    print("with uploads:", run_phase(base_url, pdf_paths, args.pollers, args.uploaders, args.seconds))
+    server.should_exit = True
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""Shared setup for the API benchmarks: serve the API in-process and time HTTP calls.
+
+Redis is fakeredis unless REDIS_HOST is set, and S3 is moto unless
+S3_BUCKET_NAME is set, so the benchmarks run without any services.
+fakeredis answers without a network round trip; `redis_latency` adds one
+to every command, so Redis calls cost what they would against a real
+server. To compare against an older revision, check it out next to the
+tree (`git worktree add /tmp/before <commit>`) and pass
+`--api-dir /tmp/before/api`.
+"""
+import os
+import sys
+import time
+import asyncio
+import tempfile
+import threading
+
+REPO_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+API_DIR = os.path.join(REPO_ROOT, "api")
+WORKER_DIR = os.path.join(REPO_ROOT, "Worker")
+
+
+def fake_redis_clients(latency=0.0):
+    """Sync and async fakeredis clients on one server, each command taking `latency` seconds."""
+    import fakeredis
+
+    class SlowRedis(fakeredis.FakeRedis):
+        def execute_command(self, *args, **options):
+            time.sleep(latency)
+            return super().execute_command(*args, **options)
+
+    class SlowAsyncRedis(fakeredis.FakeAsyncRedis):
+        async def execute_command(self, *args, **options):
+            await asyncio.sleep(latency)
+            return await super().execute_command(*args, **options)
+
+    server = fakeredis.FakeServer()
+    return (
+        SlowRedis(server=server, decode_responses=True),
+        SlowAsyncRedis(server=server, decode_responses=True)
+    )
+
+
+def start_api(api_dir=API_DIR, port=8765, redis_latency=0.0):
+    """Import `main` from `api_dir` and serve its app with uvicorn on a background thread.
+
+    The API's uploads/ and markdowns/ directories are created in a temporary
+    working directory, and fakeredis commands take `redis_latency` seconds.
+    Returns `(base_url, main_module, server)`; set `server.should_exit = True`
+    to stop it.
+    """
+    api_dir = os.path.abspath(api_dir)
+    os.chdir(tempfile.mkdtemp(prefix="bench-api-"))
+    os.environ.setdefault("LITELLM_LOCAL_MODEL_COST_MAP", "True")
+
+    mock = None
+    if not os.getenv("S3_BUCKET_NAME"):
+        from moto import mock_aws
+        os.environ.update(
+            S3_BUCKET_NAME="bench-bucket", S3_REGION="us-east-1",
+            AWS_ACCESS_KEY_ID="bench", AWS_SECRET_ACCESS_KEY="bench"
+        )
+        mock = mock_aws()
+        mock.start()
+
+    sys.path.insert(0, api_dir)
+    import main
+
+    if mock is not None:
+        main.s3_client.create_bucket(Bucket=main.S3_BUCKET_NAME)
+    if not os.getenv("REDIS_HOST"):
+        main.redis_client, async_redis = fake_redis_clients(redis_latency)
+        # Revisions before the async Redis client only have the sync one
+        if hasattr(main, "async_redis"):
+            main.async_redis = async_redis
+
+    import uvicorn
+    server = uvicorn.Server(uvicorn.Config(main.app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return f"http://127.0.0.1:{port}", main, server
+
+
+def percentile(samples, share):
+    """The `share` (0-1) percentile of `samples`, by nearest rank."""
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * share))] if ordered else float("nan")
+
+
+def latency_summary(samples):
+    """p50/p99/max of latencies given in seconds, as milliseconds."""
+    return {
+        "requests": len(samples),
+        "p50_ms": round(percentile(samples, 0.5) * 1000, 1),
+        "p99_ms": round(percentile(samples, 0.99) * 1000, 1),
+        "max_ms": round(max(samples) * 1000, 1) if samples else float("nan")
+    }
@@ -0,0 +1,39 @@
+import os
+import sys
+
+import fakeredis
+import pytest
+
+# litellm fetches its model cost map over the network at import unless told not to
+os.environ.setdefault("LITELLM_LOCAL_MODEL_COST_MAP", "True")
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Each service imports its sibling modules by bare name, as it does inside its image
+for service in ("api", "Worker"):
+    sys.path.insert(0, os.path.join(REPO_ROOT, service))
+
+
+@pytest.fixture(scope="session")
+def api_module(tmp_path_factory):
+    """The API's `main`, imported against moto S3 from a temporary working directory."""
+    from moto import mock_aws
+
+    os.environ.update(
+        S3_BUCKET_NAME="test-bucket", S3_REGION="us-east-1",
+        AWS_ACCESS_KEY_ID="test", AWS_SECRET_ACCESS_KEY="test"
+    )
+    # main creates its uploads/ and markdowns/ directories in the working directory
+    os.chdir(tmp_path_factory.mktemp("api"))
+    with mock_aws():
+        import main
+        main.s3_client.create_bucket(Bucket=main.S3_BUCKET_NAME)
+        yield main
+
+
+@pytest.fixture
+def api(api_module, monkeypatch):
+    """The API module with fresh fakeredis clients, sync and async, on one server."""
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(api_module, "redis_client", fakeredis.FakeRedis(server=server, decode_responses=True))
+    monkeypatch.setattr(api_module, "async_redis", fakeredis.FakeAsyncRedis(server=server, decode_responses=True))
+    return api_module
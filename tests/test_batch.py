@@ -0,0 +1,36 @@
+import json
+import itertools
+
+import pytest
+
+
+@pytest.fixture
+def queued(api, monkeypatch):
+    """Replace queue_summary: tasks are numbered in order and never reach a worker."""
+    task_ids = []
+    counter = itertools.count()
+
+    def queue_summary(pdf_name, llm):
+        task_ids.append(f"task-{next(counter)}")
+        # The first document's worker answers at once; the others never answer
+        if len(task_ids) == 1:
+            api.redis_client.set(f"response:{task_ids[0]}", "Summary")
+        return {"task_id": task_ids[-1]}
+
+    monkeypatch.setattr(api, "queue_summary", queue_summary)
+    return task_ids
+
+
+def test_tasks_without_a_result_time_out(api, queued, monkeypatch):
+    monkeypatch.setattr(api, "BATCH_TASK_TIMEOUT", 1)
+    api.redis_client.hset("batch:b1", mapping={"status": "queued", "total": 3, "completed": 0, "failed": 0})
+
+    api.run_batch("b1", ["a.md", "b.md", "c.md"], "GPT-4o")
+
+    batch = api.redis_client.hgetall("batch:b1")
+    assert batch["status"] == "done"
+    assert (batch["completed"], batch["failed"]) == ("1", "2")
+    tasks = {name: json.loads(entry) for name, entry in api.redis_client.hgetall("batch:b1:tasks").items()}
+    assert "error" not in tasks["a.md"]
+    assert "Timed out" in tasks["b.md"]["error"]
+    assert tasks["c.md"]["task_id"] == "task-2"
@@ -0,0 +1,75 @@
+import pytest
+from fastapi.testclient import TestClient
+
+MARKDOWN_PREFIX = "new_upload/markdown/"
+
+
+@pytest.fixture
+def bucket(api):
+    """Put markdown keys in the API's S3 bucket; every key is deleted after the test."""
+    def put(*names):
+        for name in names:
+            api.s3_client.put_object(Bucket=api.S3_BUCKET_NAME, Key=MARKDOWN_PREFIX + name, Body=b"# Doc")
+
+    yield put
+    paginator = api.s3_client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=api.S3_BUCKET_NAME):
+        keys = [{"Key": obj["Key"]} for obj in page.get("Contents", [])]
+        if keys:
+            api.s3_client.delete_objects(Bucket=api.S3_BUCKET_NAME, Delete={"Objects": keys})
+
+
+@pytest.fixture
+def client(api):
+    # Not entered as a context manager, so the lifespan's background threads do not start
+    return TestClient(api.app)
+
+
+def list_all(client, **params):
+    names, cursor = [], None
+    while True:
+        response = client.get("/select_pdfcontent/", params={**params, **({"cursor": cursor} if cursor else {})})
+        assert response.status_code == 200
+        names.extend(response.json()["markdowns"])
+        cursor = response.json()["next_cursor"]
+        if cursor is None:
+            return names
+
+
+def test_reconcile_pages_through_every_key(api, bucket):
+    # More keys than one ListObjectsV2 page holds
+    names = [f"doc-{i:04d}.md" for i in range(1050)]
+    bucket(*names, "doc-0001.bm25")
+
+    api.reconcile_catalog()
+
+    assert api.redis_client.zrange(api.CATALOG_KEY, 0, -1) == names
+
+
+def test_reconcile_removes_names_no_longer_in_s3(api, bucket):
+    bucket("kept.md")
+    api.redis_client.zadd(api.CATALOG_KEY, {"kept.md": 0, "deleted.md": 0})
+
+    api.reconcile_catalog()
+
+    assert api.redis_client.zrange(api.CATALOG_KEY, 0, -1) == ["kept.md"]
+
+
+def test_pages_cover_the_catalog_once_in_order(api, client):
+    names = sorted(f"doc-{i}.md" for i in range(250))
+    api.redis_client.zadd(api.CATALOG_KEY, {name: 0 for name in names})
+
+    first = client.get("/select_pdfcontent/", params={"limit": 100}).json()
+    assert first["markdowns"] == names[:100]
+    assert list_all(client, limit=100) == names
+    # A limit above the maximum is capped
+    assert len(client.get("/select_pdfcontent/", params={"limit": 5000}).json()["markdowns"]) == 250
+
+
+def test_prefix_selects_matching_names(api, client):
+    reports = [f"report-{year}.md" for year in range(2000, 2030)]
+    api.redis_client.zadd(api.CATALOG_KEY, {name: 0 for name in reports + ["invoice-1.md", "reportage.md", "résumé.md"]})
+
+    assert list_all(client, prefix="report-", limit=7) == reports
+    assert list_all(client, prefix="ré") == ["résumé.md"]
+    assert list_all(client, prefix="missing") == []
@@ -0,0 +1,166 @@
+import hashlib
+import os
+
+import pytest
+from fastapi.testclient import TestClient
+
+from document_cache import DocumentCache
+
+
+def head(api, key):
+    return api.s3_client.head_object(Bucket=api.S3_BUCKET_NAME, Key=key)
+
+
+def large_text(api, char):
+    return char * (api.S3_MULTIPART_CHUNK_SIZE + 1024)
+
+
+@pytest.fixture
+def upload(api):
+    """Write text to S3 through the API's S3MultipartWriter; the keys are deleted after the test."""
+    keys = []
+
+    def write(filename, text):
+        with api.S3MultipartWriter("new_upload/markdown", filename, "text/markdown") as writer:
+            for start in range(0, len(text), 1024 * 1024):
+                writer.write(text[start:start + 1024 * 1024])
+        keys.append(writer.key)
+        return writer
+
+    yield write
+    for key in keys:
+        api.s3_client.delete_object(Bucket=api.S3_BUCKET_NAME, Key=key)
+
+
+@pytest.fixture
+def cache(api):
+    # A replica that has never seen the objects: no ETags recorded, revalidated on every read
+    return DocumentCache(api.s3_client, api.S3_BUCKET_NAME, disk_bytes=1 << 30, hot_bytes=1 << 20, validate_interval=0)
+
+
+def test_small_document_is_a_single_put_with_its_hash(api, upload):
+    writer = upload("small.md", "# Small\n\nOne page.")
+
+    assert writer.upload_id is None
+    assert "-" not in writer.etag
+    assert head(api, writer.key)["Metadata"]["sha256"] == hashlib.sha256(b"# Small\n\nOne page.").hexdigest()
+
+
+def test_multipart_document_carries_its_hash(api, upload):
+    text = large_text(api, "x")
+    writer = upload("large.md", text)
+
+    assert len(writer.parts) == 2
+    metadata = head(api, writer.key)
+    assert metadata["Metadata"]["sha256"] == hashlib.sha256(text.encode()).hexdigest()
+    assert metadata["ContentType"] == "text/markdown"
+    assert metadata["ETag"].strip('"') == writer.etag
+
+
+@pytest.fixture
+def multipart_object(api):
+    """Store text as a two-part upload carrying `sha256` metadata: its ETag is not an MD5."""
+    keys = []
+
+    def put(key, text):
+        data = text.encode()
+        upload_id = api.s3_client.create_multipart_upload(
+            Bucket=api.S3_BUCKET_NAME, Key=key, Metadata={"sha256": hashlib.sha256(data).hexdigest()}
+        )["UploadId"]
+        parts = []
+        for number, start in enumerate(range(0, len(data), api.S3_MULTIPART_CHUNK_SIZE), 1):
+            response = api.s3_client.upload_part(
+                Bucket=api.S3_BUCKET_NAME, Key=key, UploadId=upload_id, PartNumber=number,
+                Body=data[start:start + api.S3_MULTIPART_CHUNK_SIZE]
+            )
+            parts.append({"ETag": response["ETag"], "PartNumber": number})
+        api.s3_client.complete_multipart_upload(
+            Bucket=api.S3_BUCKET_NAME, Key=key, UploadId=upload_id, MultipartUpload={"Parts": parts}
+        )
+        keys.append(key)
+        assert "-" in head(api, key)["ETag"]
+
+    yield put
+    for key in keys:
+        api.s3_client.delete_object(Bucket=api.S3_BUCKET_NAME, Key=key)
+
+
+def test_current_local_copy_of_a_multipart_object_is_used_without_download(api, multipart_object, cache, tmp_path):
+    text = large_text(api, "z")
+    multipart_object("new_upload/markdown/large.md", text)
+    local_path = tmp_path / "large.md"
+    local_path.write_text(text)
+
+    cache.path("new_upload/markdown/large.md", str(local_path))
+
+    assert cache.stats()["downloads"] == 0
+
+
+def test_stale_local_copy_of_a_multipart_object_is_replaced(api, multipart_object, cache, tmp_path):
+    text = large_text(api, "y")
+    multipart_object("new_upload/markdown/large.md", text)
+    local_path = tmp_path / "large.md"
+    local_path.write_text("an older version")
+
+    cache.path("new_upload/markdown/large.md", str(local_path))
+
+    assert local_path.read_text() == text
+    assert cache.stats()["downloads"] == 1
+
+
+def test_corrupted_download_of_a_multipart_object_is_rejected(api, multipart_object, cache, tmp_path, monkeypatch):
+    multipart_object("new_upload/markdown/large.md", large_text(api, "w"))
+
+    def corrupt_download(bucket, key, path):
+        with open(path, "w") as partial:
+            partial.write("# Truncat")
+
+    monkeypatch.setattr(api.s3_client, "download_file", corrupt_download)
+    with pytest.raises(IOError):
+        cache.path("new_upload/markdown/large.md", str(tmp_path / "large.md"))
+    assert not (tmp_path / "large.md").exists()
+
+
+def test_repeated_questions_read_the_index_from_memory(api, monkeypatch):
+    cache = DocumentCache(api.s3_client, api.S3_BUCKET_NAME, disk_bytes=1 << 30, hot_bytes=1 << 20)
+    monkeypatch.setattr(api, "document_cache", cache)
+    index = api.BM25Index()
+    index.add_page(1, "Invoices are due within thirty days.")
+    with open(os.path.join(api.MARKDOWN_DIR, "terms.bm25"), "wb") as index_file:
+        index_file.write(index.to_bytes())
+    cache.put("new_upload/markdown/terms.bm25", os.path.join(api.MARKDOWN_DIR, "terms.bm25"))
+
+    for _ in range(4):
+        assert api.load_bm25_index("terms.md", "hash").search("invoices due", 1)[0][0] == 1
+
+    assert cache.stats()["hot_hits"] == 2
+
+
+def test_file_held_by_a_reader_is_not_evicted(api, tmp_path):
+    cache = DocumentCache(api.s3_client, api.S3_BUCKET_NAME, disk_bytes=10, hot_bytes=0)
+    held, other = tmp_path / "held.md", tmp_path / "other.md"
+    held.write_text("held text")
+    other.write_text("other text")
+    cache.put("held.md", str(held))
+
+    assert cache.acquire("held.md", str(held)) == str(held)
+    cache.put("other.md", str(other))
+    assert held.exists()
+
+    cache.release("held.md")
+    assert not other.exists()
+    assert held.exists()
+    assert cache.stats()["evictions"] == 1
+
+
+def test_download_releases_its_file(api, monkeypatch):
+    cache = DocumentCache(api.s3_client, api.S3_BUCKET_NAME, disk_bytes=1 << 30, hot_bytes=0)
+    monkeypatch.setattr(api, "document_cache", cache)
+    with open(os.path.join(api.MARKDOWN_DIR, "download.md"), "w") as md_file:
+        md_file.write("# Download")
+    cache.put("new_upload/markdown/download.md", os.path.join(api.MARKDOWN_DIR, "download.md"))
+
+    response = TestClient(api.app).get("/download_markdown/download.md")
+
+    assert response.text == "# Download"
+    assert cache.pins == {}
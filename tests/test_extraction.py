@@ -0,0 +1,45 @@
+import io
+
+import fitz
+import pytest
+from PIL import Image
+
+import openSourcePdf
+
+
+def make_pdf(path, page_count):
+    """A PDF whose pages all show one logo (a single xref) and, on every third page, an image of their own."""
+    doc = fitz.open()
+    logo_xref = None
+    for page_num in range(page_count):
+        page = doc.new_page()
+        page.insert_text((72, 72), f"Page {page_num + 1}")
+        if logo_xref is None:
+            logo = io.BytesIO()
+            Image.new("RGB", (32, 32), (200, 30, 30)).save(logo, "PNG")
+            logo_xref = page.insert_image(fitz.Rect(20, 20, 52, 52), stream=logo.getvalue())
+        else:
+            page.insert_image(fitz.Rect(20, 20, 52, 52), xref=logo_xref)
+        if page_num % 3 == 0:
+            own = io.BytesIO()
+            Image.new("RGB", (16, 16), (0, page_num, 0)).save(own, "PNG")
+            page.insert_image(fitz.Rect(100, 100, 116, 116), stream=own.getvalue())
+    doc.save(path)
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_shared_image_is_extracted_once_per_document(tmp_path, monkeypatch, workers):
+    monkeypatch.setattr(openSourcePdf, "PAGES_PER_SHARD", 4)
+    pdf_path = str(tmp_path / "logo.pdf")
+    make_pdf(pdf_path, 23)
+    stats = openSourcePdf.new_image_stats()
+
+    pages = list(openSourcePdf.iter_pages(pdf_path, workers=workers, image_stats=stats))
+
+    # The logo plus the 8 pages with an image of their own
+    assert stats["unique_images"] == 9
+    assert stats["cache_hits"] == 22
+    logos = [page["images"][0] for page in pages]
+    assert {logo["sha256"] for logo in logos} == {logos[0]["sha256"]}
+    assert [logo["filename"] for logo in logos[:2]] == ["image_1_1.png", "image_2_1.png"]
+    assert all(logo["data"] == logos[0]["data"] for logo in logos)
@@ -0,0 +1,39 @@
+import hashlib
+import json
+
+import fitz
+
+import openSourcePdf
+from tokenization import count_tokens
+
+
+def make_pdf(path, page_count):
+    doc = fitz.open()
+    for page_num in range(page_count):
+        page = doc.new_page()
+        page.insert_text((72, 72), f"Page {page_num + 1} reports revenue for region {page_num}.")
+    doc.save(path)
+
+
+def test_ingest_streams_the_markdown_into_redis(api, tmp_path, monkeypatch):
+    monkeypatch.setattr(openSourcePdf, "EXTRACT_WORKERS", 1)
+    # Small buffers make the markdown reach Redis and the token counts in many pieces
+    monkeypatch.setattr(openSourcePdf, "MARKDOWN_BUFFER_SIZE", 64)
+    pdf_path = str(tmp_path / "regions.pdf")
+    make_pdf(pdf_path, 12)
+
+    api.ingest_pdf(pdf_path, "regions.md")
+
+    with open("markdowns/regions.md", encoding="utf-8") as md_file:
+        markdown = md_file.read()
+    content_hash = api.redis_client.get("doc_hash:regions.md")
+    assert content_hash == hashlib.sha256(markdown.encode()).hexdigest()
+    assert api.redis_client.get(f"document:{content_hash}") == markdown
+    assert "region 11" in api.redis_client.get("extracted_text:regions.md")
+    assert api.redis_client.keys("staging:*") == []
+
+    stats = json.loads(api.redis_client.get("doc_stats:regions.md"))
+    assert stats["pages"] == 12
+    assert stats["bytes"] == len(markdown.encode())
+    for model in api.TOKEN_COUNT_MODELS:
+        assert abs(stats["tokens"][model] - count_tokens(markdown, model)) <= 12
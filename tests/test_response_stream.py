@@ -0,0 +1,46 @@
+import asyncio
+
+import fakeredis
+import pytest
+
+import worker
+
+
+@pytest.fixture
+def worker_redis(monkeypatch):
+    client = fakeredis.FakeRedis(decode_responses=True)
+    monkeypatch.setattr(worker, "redis_client", client)
+    return client
+
+
+def test_rerun_task_replaces_the_partial_stream(worker_redis):
+    # First attempt streams part of its answer, then its replica dies
+    crashed = worker.ResponseStream("task-1")
+    crashed.start()
+    crashed.write("Partial")
+    assert 0 < worker_redis.ttl(crashed.key) <= worker.RESPONSE_STREAM_TTL
+
+    retry = worker.ResponseStream("task-1")
+    retry.start()
+    retry.write("Full answer")
+    retry.close("Full answer")
+
+    entries = [fields for _, fields in worker_redis.xrange(retry.key)]
+    assert entries == [{"reset": "1"}, {"delta": "Full answer"}, {"done": "1"}]
+
+
+def collect(api, task_id):
+    async def run():
+        return [event async for event in api.result_events(task_id, timeout=5)]
+    return asyncio.run(run())
+
+
+def test_reader_is_told_to_discard_an_earlier_attempt(api):
+    key = "response_stream:task-1"
+    # What a reader that tailed both attempts sees
+    for fields in ({"reset": "1"}, {"delta": "Partial"}, {"reset": "1"}, {"delta": "Full"}, {"done": "1"}):
+        api.redis_client.xadd(key, fields)
+
+    assert collect(api, "task-1") == [
+        'data: "Partial"\n\n', "event: reset\ndata: {}\n\n", 'data: "Full"\n\n', "event: done\ndata: {}\n\n"
+    ]
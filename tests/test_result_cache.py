@@ -0,0 +1,19 @@
+import json
+
+
+def queue(api, monkeypatch, context):
+    monkeypatch.setattr(api, "retrieve_context", lambda pdf_name, content_hash, question: context)
+    return api.queue_question("report.md", "GPT-4o", "What was revenue?")
+
+
+def test_answers_are_cached_per_retrieved_context(api, monkeypatch):
+    api.publish_document("report.md", "# Report\n\nRevenue grew 12%.")
+
+    # Answered from the whole document, then cached by the worker under the task's key
+    assert queue(api, monkeypatch, None)["cached"] is False
+    task = json.loads(api.redis_client.xrange(api.STREAM_NAME)[-1][1]["data"])
+    api.redis_client.set(task["cache_key"], "Revenue grew 12%.")
+
+    assert queue(api, monkeypatch, None)["cached"] is True
+    # Excerpt mode sends other context, so the full-document answer is not reused
+    assert queue(api, monkeypatch, [{"page": 1, "text": "Revenue grew 12%."}])["cached"] is False
@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+
+from retrieval import HashingEmbedder, VectorIndex, chunk_page
+from tokenization import token_windows
+
+
+def test_hashing_index_finds_the_relevant_chunk():
+    chunks = chunk_page(1, "### Page 1\n\nThe warehouse in Lyon ships furniture.") + \
+        chunk_page(2, "### Page 2\n\nQuarterly revenue grew 12 percent in Asia.")
+    index = VectorIndex.from_bytes(VectorIndex.build(chunks, HashingEmbedder()).to_bytes())
+
+    score, page_num, text = index.search("How much did revenue grow?", 1)[0]
+    assert page_num == 2
+    assert "revenue" in text
+
+
+def test_index_from_an_unavailable_model_cannot_be_searched():
+    # Built by a replica that had a 384-dimension sentence-transformers model
+    index = VectorIndex("missing-model", np.ones((2, 384), dtype=np.float32), np.array([1, 2]), ["a", "b"])
+
+    with pytest.raises(ValueError):
+        index.search("anything", 1)
+
+
+def test_short_tail_is_merged_into_the_last_window():
+    words = " ".join(f"w{i}" for i in range(359))
+    # An unknown model counts one token per word; a second window would add only 9 new ones
+    windows = token_windows(words, "Grok-none", 350, 50)
+
+    assert len(windows) == 1
+    assert windows[0].split()[-1] == "w358"
+
+
+def test_windows_overlap_and_cover_the_text():
+    words = [f"w{i}" for i in range(700)]
+    windows = [window.split() for window in token_windows(" ".join(words), "Grok-none", 350, 50)]
+
+    assert [(window[0], window[-1]) for window in windows] == [("w0", "w349"), ("w300", "w649"), ("w600", "w699")]
@@ -0,0 +1,119 @@
+import threading
+
+import litellm
+import pytest
+
+import scheduler
+import worker
+from scheduler import ModelScheduler, TokenBucket
+from tokenization import count_tokens
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """Record the scheduler's sleeps instead of waiting them out."""
+    recorded = []
+    monkeypatch.setattr(scheduler.time, "sleep", recorded.append)
+    return recorded
+
+
+def test_bucket_delays_reservations_beyond_its_balance():
+    bucket = TokenBucket(per_minute=600)  # 10 units per second
+
+    assert bucket.reserve(600) == 0
+    assert bucket.reserve(50) == pytest.approx(5, abs=0.1)
+    # Later callers queue behind the debt of earlier ones
+    assert bucket.reserve(50) == pytest.approx(10, abs=0.1)
+
+
+def test_request_larger_than_the_bucket_waits_at_most_one_refill():
+    bucket = TokenBucket(per_minute=600)
+    bucket.reserve(600)
+
+    assert bucket.reserve(10_000) == pytest.approx(60, abs=0.1)
+
+
+def test_scheduler_holds_calls_over_the_token_budget(sleeps):
+    model = ModelScheduler(max_concurrency=4, tpm=6000)  # 100 tokens per second
+
+    with model.admit(6000):
+        pass
+    with model.admit(300):
+        pass
+
+    assert sleeps == [pytest.approx(3, abs=0.1)]
+    assert model.metrics()["admitted"] == 2
+
+
+def test_scheduler_caps_concurrent_calls():
+    model = ModelScheduler(max_concurrency=2)
+    running, peak, lock = [0], [0], threading.Lock()
+    release = threading.Event()
+
+    def call():
+        with model.admit(1):
+            with lock:
+                running[0] += 1
+                peak[0] = max(peak[0], running[0])
+            release.wait(5)
+            with lock:
+                running[0] -= 1
+
+    threads = [threading.Thread(target=call) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    threading.Timer(0.3, release.set).start()
+    for thread in threads:
+        thread.join()
+
+    assert peak[0] == 2
+
+
+class MockProvider:
+    """Stands in for `litellm.completion`: rate-limits the first `failures` calls, then answers."""
+
+    def __init__(self, failures):
+        self.failures = failures
+        self.calls = 0
+
+    def __call__(self, model, messages, **kwargs):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise litellm.RateLimitError("Rate limit reached", llm_provider="openai", model=model)
+        return {"choices": [{"message": {"content": "Answer"}}]}
+
+
+@pytest.fixture
+def provider_scheduler(monkeypatch):
+    monkeypatch.setattr(worker, "LLM_BACKOFF_BASE", 0.01)
+    model = ModelScheduler(max_concurrency=1)
+    monkeypatch.setitem(worker.model_schedulers, "GPT-4o", model)
+    return model
+
+
+def test_rate_limited_call_is_retried(monkeypatch, provider_scheduler):
+    provider = MockProvider(failures=2)
+    monkeypatch.setattr(worker.litellm, "completion", provider)
+
+    assert worker.complete("GPT-4o", worker.LLM_MODELS["GPT-4o"], "Hello") == "Answer"
+    assert provider.calls == 3
+    assert provider_scheduler.metrics()["retries"] == 2
+    # Every attempt goes back through the scheduler
+    assert provider_scheduler.metrics()["admitted"] == 3
+
+
+def test_retries_give_up_with_an_error(monkeypatch, provider_scheduler):
+    provider = MockProvider(failures=worker.LLM_MAX_RETRIES + 1)
+    monkeypatch.setattr(worker.litellm, "completion", provider)
+
+    result = worker.complete("GPT-4o", worker.LLM_MODELS["GPT-4o"], "Hello")
+
+    assert result.startswith("❌")
+    assert provider.calls == worker.LLM_MAX_RETRIES + 1
+
+
+def test_summary_prompts_fit_the_tokens_per_minute_limit():
+    tpm = worker.LLM_MODELS["GPT-4o"]["tpm"] * worker.RATE_LIMIT_SHARE
+    prompt_tokens = worker.summary_chunk_budget("GPT-4o") + count_tokens(worker.SUMMARY_REDUCE_PROMPT, "GPT-4o")
+
+    assert prompt_tokens + worker.RATE_LIMIT_OUTPUT_TOKENS <= tpm
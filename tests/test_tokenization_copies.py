@@ -0,0 +1,17 @@
+import os
+
+from conftest import REPO_ROOT
+
+# Each service image is built from its own directory, so the shared tokenizer is copied into all of them
+COPIES = [os.path.join(REPO_ROOT, service, "tokenization.py") for service in ("api", "Worker", "app")]
+
+
+def test_tokenization_copies_are_identical():
+    contents = {}
+    for path in COPIES:
+        with open(path, encoding="utf-8") as copy:
+            contents[os.path.relpath(path, REPO_ROOT)] = copy.read()
+
+    reference = contents["api/tokenization.py"]
+    diverged = [path for path, text in contents.items() if text != reference]
+    assert not diverged, f"{', '.join(diverged)} differ from api/tokenization.py; copy the change to every service"
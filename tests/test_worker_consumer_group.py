@@ -0,0 +1,152 @@
+import json
+import time
+import threading
+from collections import Counter
+
+import fakeredis
+import pytest
+
+import worker
+
+
+def wait_until(condition, timeout=15):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def add_task(task_id):
+    worker.redis_client.xadd(worker.STREAM_NAME, {"data": json.dumps({
+        "task_id": task_id,
+        "type": "qa",
+        "pdf_name": "report.md",
+        "llm": "GPT-4o",
+        "question": f"What does {task_id} say?",
+        "content": "Revenue grew 12% in 2024."
+    })})
+
+
+class FakeLLM:
+    """Stands in for `call_llm`: counts calls per prompt and takes `delay` seconds to answer."""
+
+    def __init__(self, delay=0.01):
+        self.delay = delay
+        self.calls = Counter()
+        self.lock = threading.Lock()
+
+    def __call__(self, llm_name, prompt, cache_key=None, on_delta=None):
+        with self.lock:
+            self.calls[prompt] += 1
+        time.sleep(self.delay)
+        return "Answer"
+
+
+@pytest.fixture
+def llm(monkeypatch):
+    monkeypatch.setattr(worker, "redis_client", fakeredis.FakeRedis(decode_responses=True))
+    fake = FakeLLM()
+    monkeypatch.setattr(worker, "call_llm", fake)
+    return fake
+
+
+@pytest.fixture
+def start_consumers():
+    """Run consumer loops under the given names; all of them are stopped after the test."""
+    threads = []
+
+    def start(*names):
+        worker.shutting_down.clear()
+        for name in names:
+            thread = threading.Thread(target=worker.process_redis_messages, args=(name,), daemon=True)
+            thread.start()
+            threads.append(thread)
+
+    yield start
+    worker.shutting_down.set()
+    for thread in threads:
+        thread.join(timeout=10)
+    assert wait_until(lambda: not worker.in_flight_messages)
+
+
+def results(task_ids):
+    return worker.redis_client.mget([f"response:{task_id}" for task_id in task_ids])
+
+
+def pending_count():
+    return worker.redis_client.xpending(worker.STREAM_NAME, worker.CONSUMER_GROUP)["pending"]
+
+
+def test_each_task_is_processed_once_across_consumers(llm, start_consumers):
+    task_ids = [f"task-{i}" for i in range(30)]
+    worker.ensure_consumer_group()
+    for task_id in task_ids:
+        add_task(task_id)
+
+    start_consumers("replica-a", "replica-b", "replica-c")
+
+    assert wait_until(lambda: all(results(task_ids)))
+    assert wait_until(lambda: pending_count() == 0)
+    assert len(llm.calls) == len(task_ids)
+    assert set(llm.calls.values()) == {1}
+    # Acknowledged entries are deleted from the stream
+    assert worker.redis_client.xlen(worker.STREAM_NAME) == 0
+
+
+def test_entries_of_a_crashed_consumer_are_reclaimed(llm, start_consumers, monkeypatch):
+    monkeypatch.setattr(worker, "CLAIM_IDLE_MS", 200)
+    monkeypatch.setattr(worker, "CLAIM_INTERVAL", 0)
+    task_ids = [f"task-{i}" for i in range(3)]
+    worker.ensure_consumer_group()
+    for task_id in task_ids:
+        add_task(task_id)
+
+    # A replica reads the entries and dies before acknowledging them
+    worker.redis_client.xreadgroup(worker.CONSUMER_GROUP, "crashed", {worker.STREAM_NAME: ">"}, count=3)
+    assert pending_count() == 3
+
+    start_consumers("survivor")
+
+    assert wait_until(lambda: all(results(task_ids)))
+    assert wait_until(lambda: pending_count() == 0)
+    assert set(llm.calls.values()) == {1}
+
+
+def test_long_running_task_is_not_dispatched_again(llm, start_consumers, monkeypatch):
+    monkeypatch.setattr(worker, "CLAIM_IDLE_MS", 300)
+    monkeypatch.setattr(worker, "CLAIM_INTERVAL", 0)
+    # Without heartbeats the entry goes idle while it runs; the consumer's own sweeps must skip it
+    monkeypatch.setattr(worker, "CLAIM_HEARTBEAT_INTERVAL", 60)
+    llm.delay = 1.5
+    worker.ensure_consumer_group()
+    add_task("slow-task")
+
+    start_consumers("replica-a")
+
+    assert wait_until(lambda: all(results(["slow-task"])))
+    assert wait_until(lambda: pending_count() == 0)
+    assert list(llm.calls.values()) == [1]
+
+
+def test_heartbeat_keeps_running_task_from_other_replicas(llm, start_consumers, monkeypatch):
+    monkeypatch.setattr(worker, "CLAIM_IDLE_MS", 300)
+    monkeypatch.setattr(worker, "CLAIM_INTERVAL", 60)
+    monkeypatch.setattr(worker, "CLAIM_HEARTBEAT_INTERVAL", 0.1)
+    llm.delay = 1.5
+    worker.ensure_consumer_group()
+    add_task("slow-task")
+
+    start_consumers("replica-a")
+
+    assert wait_until(lambda: worker.in_flight_messages)
+    time.sleep(0.8)
+    # A replica sweeping for stale entries finds nothing: the heartbeat keeps the running entry fresh
+    claimed = worker.redis_client.xautoclaim(
+        worker.STREAM_NAME, worker.CONSUMER_GROUP, "other-replica", min_idle_time=300, start_id="0-0"
+    )[1]
+    assert claimed == []
+
+    assert wait_until(lambda: all(results(["slow-task"])))
+    assert list(llm.calls.values()) == [1]